@@ -0,0 +1,46 @@
+# The grammar corpus: (text, start rule) by name. The example DSL from
+# examples/, the .ebnf files in this directory, and large generated grammars.
+
+import os
+import random
+
+HERE = os.path.dirname(__file__)
+EXAMPLES = os.path.join(HERE, "..", "..", "examples")
+
+
+def read(path):
+    with open(path, "r") as file:
+        return file.read()
+
+
+# A command language with `num_commands` commands, each taking a few typed
+# arguments, e.g. `cmd_17(ident, 42, "text")`. Stands in for grammars
+# generated from large tool or API schemas: many rules and literals, and a
+# wide fan-out after the shared `cmd_` prefix.
+def generated(num_commands=200, seed=0):
+    rng = random.Random(seed)
+    types = ["ident", "number", "string", "flag", "list"]
+    lines = [
+        'root ::= (command "\\n")+',
+        "command ::= " + " | ".join(f"cmd{i}" for i in range(num_commands)),
+    ]
+    for i in range(num_commands):
+        args = ' ", " '.join(rng.choice(types) for _ in range(rng.randint(1, 4)))
+        lines.append(f'cmd{i} ::= "cmd_{i}(" {args} ")"')
+    lines += [
+        "ident ::= [a-zA-Z_] [a-zA-Z0-9_]*",
+        'number ::= "-"? [0-9]+ ("." [0-9]+)?',
+        'string ::= "\\"" [ !#-~]* "\\""',
+        'flag ::= "true" | "false"',
+        'list ::= "[" (number (", " number)*)? "]"',
+    ]
+    return "\n".join(lines) + "\n"
+
+
+GRAMMARS = {
+    "dsl": lambda: (read(os.path.join(EXAMPLES, "grammar.ebnf")), "root"),
+    "json": lambda: (read(os.path.join(HERE, "json.ebnf")), "root"),
+    "arithmetic": lambda: (read(os.path.join(HERE, "arithmetic.ebnf")), "root"),
+    "generated": lambda: (generated(200), "root"),
+    "generated_large": lambda: (generated(2000), "root"),
+}
@@ -0,0 +1,227 @@
+# Offline benchmarks: every combination of synthetic tokenizer, vocab size and
+# corpus grammar, with results as JSON that can be diffed against a baseline.
+#
+# Each case runs in a fresh process, so that peak RSS and the samplers'
+# caches are its own. Decoding samples the argmax of random logits after
+# masking, from a fixed seed, until `tokens` tokens have been generated
+# (starting a new sequence after EOS). "cold" latencies are for that first
+# pass, with every cache empty; "warm" ones replay the same sequences on the
+# same sampler.
+#
+# compare_optimizer() checks that the grammar optimizer pays for itself: the
+# same cases with `optimize=False` should not have faster cold steps, nor do
+# less work in them.
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import numpy as np
+import torch
+from torch_grammar import GrammarSampler, Metrics
+from torch_grammar.grammar_parser import parse
+from torch_grammar.token_trie import TokenTrie
+from .grammars import GRAMMARS
+from .tokenizers import TOKENIZERS
+
+SIZES = (32000, 150000)
+
+# Metrics checked by compare(); lower is better for all of them.
+TRACKED = (
+    "parse_s",
+    "vocab_s",
+    "construct_s",
+    "cold.p50_ms",
+    "cold.p99_ms",
+    "warm.p50_ms",
+    "warm.p99_ms",
+    "peak_rss_mb",
+)
+
+# Metrics checked by compare_optimizer(): cold-step latencies, and the work
+# done in cold steps, which unlike latencies doesn't depend on the machine.
+OPTIMIZER_TRACKED = ("cold.mean_ms", "cold.p99_ms", "cold.max_ms")
+OPTIMIZER_WORK = ("metrics.counters.masks_computed", "metrics.histograms.stacks.sum")
+
+
+def latency_stats(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "max_ms": float(ms.max()),
+    }
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+# Sample `tokens` tokens, returning the sequences generated and the latency of
+# each processor call.
+def decode(grammar, bos_token_id, vocab_size, tokens, seed):
+    generator = torch.Generator().manual_seed(seed)
+    sequences = []
+    latencies = []
+    while len(latencies) < tokens:
+        # The first step of a sequence includes creating its processor, which
+        # expands the start rule.
+        st = time.perf_counter()
+        processor = grammar.logits_processor()
+        setup = time.perf_counter() - st
+        ids = [] if bos_token_id is None else [bos_token_id]
+        sequences.append(ids)
+        while True:
+            scores = torch.randn((1, vocab_size), generator=generator)
+            st = time.perf_counter()
+            scores = processor([ids], scores)
+            latencies.append(time.perf_counter() - st + setup)
+            setup = 0
+            token = torch.argmax(scores).item()
+            if token == grammar.eos_token_id or len(latencies) == tokens:
+                break
+            ids.append(token)
+    return sequences, latencies
+
+
+# Make the same processor calls as decode() did for `sequences`.
+def replay(grammar, sequences, bos_token_id, vocab_size):
+    latencies = []
+    scores = torch.zeros((1, vocab_size))
+    start = 0 if bos_token_id is None else 1
+    for ids in sequences:
+        processor = grammar.logits_processor()
+        for n in range(start, len(ids) + 1):
+            st = time.perf_counter()
+            processor([ids[:n]], scores.clone())
+            latencies.append(time.perf_counter() - st)
+    return latencies
+
+
+def run_case(
+    tokenizer_name, vocab_size, grammar_name, tokens=200, seed=0, optimize=True
+):
+    tokenizer = TOKENIZERS[tokenizer_name](vocab_size, seed)
+    text, start_rule_name = GRAMMARS[grammar_name]()
+
+    st = time.perf_counter()
+    parse(text)
+    parse_s = time.perf_counter() - st
+
+    st = time.perf_counter()
+    trie = TokenTrie(tokenizer)
+    vocab_s = time.perf_counter() - st
+
+    st = time.perf_counter()
+    grammar = GrammarSampler(
+        text, start_rule_name, trie, optimize=optimize, metrics=Metrics()
+    )
+    construct_s = time.perf_counter() - st
+
+    size = len(tokenizer.get_vocab())
+    sequences, cold = decode(grammar, tokenizer.bos_token_id, size, tokens, seed)
+    warm = replay(grammar, sequences, tokenizer.bos_token_id, size)
+    return {
+        "vocab_size": size,
+        "tokens": len(cold),
+        "parse_s": parse_s,
+        "vocab_s": vocab_s,
+        "construct_s": construct_s,
+        "cold": latency_stats(cold),
+        "warm": latency_stats(warm),
+        "metrics": grammar.metrics.summary(),
+        "caches": grammar.cache_stats(),
+        "memory_usage": grammar.memory_usage(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def case_name(tokenizer_name, vocab_size, grammar_name):
+    return f"{tokenizer_name}-{vocab_size // 1000}k/{grammar_name}"
+
+
+# Run every case and return {"meta": ..., "results": {case name: metrics}}.
+# With `isolate`, each case gets its own process.
+def run(
+    tokenizers=tuple(TOKENIZERS),
+    sizes=SIZES,
+    grammars=tuple(GRAMMARS),
+    tokens=200,
+    seed=0,
+    optimize=True,
+    isolate=True,
+    log=None,
+):
+    results = {}
+    for tokenizer_name in tokenizers:
+        for vocab_size in sizes:
+            for grammar_name in grammars:
+                args = (
+                    tokenizer_name,
+                    vocab_size,
+                    grammar_name,
+                    tokens,
+                    seed,
+                    optimize,
+                )
+                if isolate:
+                    context = multiprocessing.get_context("spawn")
+                    with ProcessPoolExecutor(1, mp_context=context) as pool:
+                        result = pool.submit(run_case, *args).result()
+                else:
+                    result = run_case(*args)
+                name = case_name(tokenizer_name, vocab_size, grammar_name)
+                results[name] = result
+                if log is not None:
+                    log(name, result)
+    meta = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "tokens": tokens,
+        "seed": seed,
+        "optimize": optimize,
+    }
+    return {"meta": meta, "results": results}
+
+
+def lookup(metrics, key):
+    for part in key.split("."):
+        metrics = metrics.get(part) if isinstance(metrics, dict) else None
+    return metrics
+
+
+# The tracked metrics (`keys`) that got worse than in `baseline` by more than
+# `threshold` (a fraction) and by more than `slack` (in the metric's units),
+# as (case, metric, baseline, current) tuples. Cases missing from either side
+# are skipped.
+def compare(current, baseline, threshold=0.2, keys=TRACKED, slack=0.0):
+    regressions = []
+    for name, metrics in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for key in keys:
+            old = lookup(base, key)
+            new = lookup(metrics, key)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > slack:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+# Run the cases twice, with and without the grammar optimizer, and return the
+# metrics (`keys`) that the optimizer made worse (see compare). By default,
+# these are latencies, and ones within a millisecond of each other are noise
+# at the scale of these cases.
+def compare_optimizer(threshold=0.2, keys=OPTIMIZER_TRACKED, slack=1.0, **kwargs):
+    optimized = run(optimize=True, **kwargs)
+    unoptimized = run(optimize=False, **kwargs)
+    return compare(optimized, unoptimized, threshold, keys, slack)
@@ -0,0 +1,93 @@
+# Synthetic vocabularies for benchmarking without downloading a tokenizer.
+#
+# Both have every single byte as a token, so any output is reachable, plus
+# generated pieces (words with and without a leading space, numbers,
+# punctuation runs, indentation) up to the requested size. The pieces are
+# drawn from a seeded RNG, so a given (size, seed) always gives the same
+# vocab. The class names matter: TokenTrie picks its token formatting based on
+# them.
+
+import random
+from torch_grammar.token_trie import bytes_to_unicode
+
+LETTERS = "etaoinshrdlucmfwypvbgkjqxz"
+PUNCTUATION = "{}[]()<>:;,.\"'=+-*/\\_#@!?&|%$^~`"
+
+
+# Generated piece texts (with spaces as " "), distinct and in a stable order.
+def generate_pieces(n, seed):
+    rng = random.Random(seed)
+    # Zipf-ish letter frequencies so that the trie has realistic fan-out.
+    weights = [1 / (i + 1) for i in range(len(LETTERS))]
+    pieces = {}
+    while len(pieces) < n:
+        kind = rng.random()
+        if kind < 0.7:
+            k = min(1 + int(rng.expovariate(0.3)), 16)
+            piece = "".join(rng.choices(LETTERS, weights, k=k))
+            if rng.random() < 0.5:
+                piece = " " + piece
+            elif rng.random() < 0.2:
+                piece = piece.capitalize()
+        elif kind < 0.8:
+            piece = str(rng.randrange(10 ** rng.randint(1, 3)))
+        elif kind < 0.95:
+            piece = "".join(rng.choices(PUNCTUATION, k=rng.randint(1, 3)))
+            if rng.random() < 0.3:
+                piece = " " + piece
+        else:
+            piece = " " * rng.randint(2, 16)
+        pieces[piece] = None
+    return list(pieces)
+
+
+# SentencePiece style: `<0xNN>` byte fallback tokens and `▁` for spaces.
+class SyntheticLlamaTokenizer:
+    bos_token_id = 1
+    eos_token_id = 2
+
+    def __init__(self, size=32000, seed=0):
+        tokens = ["<unk>", "<s>", "</s>"]
+        tokens += ["<0x%02X>" % i for i in range(256)]
+        pieces = generate_pieces(size - len(tokens), seed)
+        tokens += [piece.replace(" ", "▁") for piece in pieces]
+        self.tokens = tokens
+        self.vocab = {token: i for i, token in enumerate(tokens)}
+
+    def get_vocab(self):
+        return self.vocab
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.tokens[token_id]
+
+
+# Byte-level BPE (GPT-2) style: every byte spelled as one printable character.
+class SyntheticGPT2Tokenizer:
+    bos_token_id = None
+    eos_token_id = 0
+    additional_special_tokens_ids = []
+
+    def __init__(self, size=32000, seed=0):
+        chars = bytes_to_unicode()
+        tokens = ["<|endoftext|>"]
+        tokens += [chars[b] for b in range(256)]
+        # Single characters are already there as bytes.
+        for piece in generate_pieces(size, seed):
+            if len(tokens) == size:
+                break
+            if len(piece) > 1:
+                tokens.append("".join(chars[b] for b in piece.encode("utf-8")))
+        self.tokens = tokens
+        self.vocab = {token: i for i, token in enumerate(tokens)}
+
+    def get_vocab(self):
+        return self.vocab
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.tokens[token_id]
+
+
+TOKENIZERS = {
+    "llama": SyntheticLlamaTokenizer,
+    "gpt2": SyntheticGPT2Tokenizer,
+}
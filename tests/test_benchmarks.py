@@ -0,0 +1,52 @@
+import copy
+import unittest
+from benchmarks import suite
+from benchmarks.tokenizers import SyntheticGPT2Tokenizer, SyntheticLlamaTokenizer
+from torch_grammar.token_trie import TokenTrie
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_tokenizers(self):
+        for cls in (SyntheticLlamaTokenizer, SyntheticGPT2Tokenizer):
+            tokenizer = cls(1000, seed=1)
+            self.assertEqual(len(tokenizer.get_vocab()), 1000)
+            self.assertEqual(cls(1000, seed=1).tokens, tokenizer.tokens)
+            # every byte is a token
+            trie = TokenTrie(tokenizer)
+            lengths = {len(trie.id2str(i)) for i in range(1000) if trie.id2str(i)}
+            self.assertIn(1, lengths)
+            self.assertGreater(max(lengths), 4)
+
+    def test_run_and_compare(self):
+        results = suite.run(
+            tokenizers=["llama"],
+            sizes=[2000],
+            grammars=["dsl"],
+            tokens=20,
+            isolate=False,
+        )
+        metrics = results["results"]["llama-2k/dsl"]
+        self.assertEqual(metrics["tokens"], 20)
+        self.assertGreater(metrics["cold"]["p99_ms"], 0)
+        self.assertEqual(suite.compare(results, results), [])
+
+        slower = copy.deepcopy(results)
+        slower["results"]["llama-2k/dsl"]["warm"]["p50_ms"] *= 2
+        self.assertEqual(
+            [(name, key) for name, key, _, _ in suite.compare(slower, results)],
+            [("llama-2k/dsl", "warm.p50_ms")],
+        )
+
+    def test_optimizer_does_not_add_cold_work(self):
+        # Work rather than latency, which is too noisy for a unit test.
+        regressions = suite.compare_optimizer(
+            threshold=0.0,
+            keys=suite.OPTIMIZER_WORK,
+            slack=0.0,
+            tokenizers=["llama"],
+            sizes=[2000],
+            grammars=["dsl", "json", "arithmetic", "generated"],
+            tokens=50,
+            isolate=False,
+        )
+        self.assertEqual(regressions, [])
@@ -0,0 +1,77 @@
+import gc
+import unittest
+import weakref
+import numpy as np
+import torch
+from torch_grammar import GrammarSampler
+from torch_grammar.caches import CachePool, ENTRY_BYTES
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestCaches(unittest.TestCase):
+    def test_expensive_entries_outlive_cheap_ones(self):
+        pool = CachePool(budget=3 * (ENTRY_BYTES + 100))
+        masks = pool["masks"]
+        words = np.zeros(4, dtype=np.uint64)
+        masks.put("slow", words, cost=1.0, size=100)
+        masks.put("fast", words, cost=0.001, size=100)
+        masks.put("medium", words, cost=0.1, size=100)
+        masks.put("new", words, cost=0.01, size=100)
+        self.assertEqual(set(masks.entries), {"slow", "medium", "new"})
+        self.assertLessEqual(pool.usage, pool.budget)
+        self.assertEqual(masks.stats()["evictions"], 1)
+
+    def test_small_budget_gives_same_masks(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        ids = [1] + tokenizer.encode("info(abc)\nt(ab: #ff")
+        vocab_size = len(tokenizer.get_vocab())
+
+        masks = {}
+        for budget in (None, 20000):
+            grammar = GrammarSampler(
+                input_text,
+                "root",
+                tokenizer,
+                host_cache_bytes=budget,
+                device_cache_bytes=budget and 256,
+            )
+            processor = grammar.logits_processor()
+            masks[budget] = []
+            for n in range(1, len(ids) + 1):
+                scores = processor([ids[:n]], torch.zeros((1, vocab_size)))
+                masks[budget].append(torch.isfinite(scores[0]))
+            usage = grammar.memory_usage()
+            if budget is not None:
+                # interned states are counted but not budgeted
+                self.assertLessEqual(usage["host"] - usage["states"], budget)
+                self.assertLessEqual(usage["devices"]["cpu"], 256)
+                stats = grammar.cache_stats()
+                self.assertGreater(sum(s["evictions"] for s in stats.values()), 0)
+        for unbounded, bounded in zip(masks[None], masks[20000]):
+            self.assertTrue(torch.equal(unbounded, bounded))
+
+    def test_precompiled_masks_are_budgeted(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        grammar = GrammarSampler(input_text, "root", tokenizer, host_cache_bytes=8000)
+        result = grammar.precompile(workers=0)
+        self.assertGreater(result["computed"], 0)
+        usage = grammar.memory_usage()
+        self.assertLessEqual(usage["host"] - usage["states"], 8000)
+        stats = grammar.cache_stats()["token_acceptance_for_stack"]
+        self.assertGreater(stats["evictions"], 0)
+
+        grammar.state_acceptance(grammar.init_state())
+        self.assertGreater(grammar.memory_usage()["states"], 0)
+
+    def test_sampler_is_freed(self):
+        tokenizer = ToyLlamaTokenizer()
+        grammar = GrammarSampler('root ::= "a"+\n', "root", tokenizer)
+        grammar.state_acceptance(grammar.init_state())
+        ref = weakref.ref(grammar)
+        del grammar
+        gc.collect()
+        self.assertIsNone(ref())
@@ -0,0 +1,187 @@
+import os
+import tempfile
+import unittest
+import torch
+from torch_grammar import GrammarSampler, Metrics
+from torch_grammar.grammar_cache import MaskFile, MIN_RECORDS
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestGrammarCache(unittest.TestCase):
+    def generate_masks(self, grammar, ids):
+        vocab_size = len(grammar.token_trie)
+        processor = grammar.logits_processor()
+        masks = []
+        for n in range(1, len(ids) + 1):
+            scores = processor([ids[:n]], torch.zeros((1, vocab_size)))
+            masks.append(torch.isfinite(scores[0]))
+        return masks
+
+    def computed(self, grammar):
+        return grammar.metrics.counters.get("masks_computed", 0)
+
+    def test_second_sampler_reuses_grammar_and_masks(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        ids = [1] + tokenizer.encode("t(ab: #ff")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold = GrammarSampler(
+                input_text, "root", tokenizer, cache_dir=cache_dir, metrics=Metrics()
+            )
+            cold_masks = self.generate_masks(cold, ids)
+            self.assertGreater(self.computed(cold), 0)
+
+            warm = GrammarSampler(
+                input_text, "root", tokenizer, cache_dir=cache_dir, metrics=Metrics()
+            )
+            self.assertEqual(warm.src, cold.src)
+            self.assertEqual(warm.token_trie.tokens, cold.token_trie.tokens)
+            warm_masks = self.generate_masks(warm, ids)
+            self.assertEqual(self.computed(warm), 0)
+            for cold_mask, warm_mask in zip(cold_masks, warm_masks):
+                self.assertTrue(torch.equal(cold_mask, warm_mask))
+
+            # a different start rule is a different grammar
+            other = GrammarSampler(
+                input_text, "info", tokenizer, cache_dir=cache_dir, metrics=Metrics()
+            )
+            self.generate_masks(other, [1])
+            self.assertGreater(self.computed(other), 0)
+
+    def test_deeply_nested_stacks_are_persisted(self):
+        tokenizer = ToyLlamaTokenizer()
+        input_text = 'root ::= x\nx ::= "(" x ")" | "a"\n'
+        ids = [1] + tokenizer.encode("(" * 2000 + "a")
+        vocab_size = len(tokenizer.tokens)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            masks = []
+            for _ in range(2):
+                grammar = GrammarSampler(
+                    input_text, "root", tokenizer, cache_dir=cache_dir
+                )
+                processor = grammar.logits_processor()
+                processor([ids[:1]], torch.zeros((1, vocab_size)))
+                # all tokens at once, so no shorter stack was digested first
+                scores = processor([ids], torch.zeros((1, vocab_size)))
+                masks.append(torch.isfinite(scores[0]))
+            self.assertEqual(
+                masks[0].nonzero().flatten().tolist(), [tokenizer.encode(")")[0]]
+            )
+            self.assertTrue(torch.equal(masks[0], masks[1]))
+
+    def test_precompile_warms_masks(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        ids = [1] + tokenizer.encode('nav("/ab/")\ninfo(x)')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            grammar = GrammarSampler(
+                input_text, "root", tokenizer, cache_dir=cache_dir, metrics=Metrics()
+            )
+            result = grammar.precompile(workers=2)
+            self.assertEqual(result["computed"], result["stacks"])
+            self.generate_masks(grammar, ids)
+            self.assertEqual(self.computed(grammar), 0)
+
+            # the masks were computed in worker processes and persisted
+            warm = GrammarSampler(
+                input_text, "root", tokenizer, cache_dir=cache_dir, metrics=Metrics()
+            )
+            self.generate_masks(warm, ids)
+            self.assertEqual(self.computed(warm), 0)
+
+    def test_precompile_warms_merged_states(self):
+        # After "ab", z can be entered from either alternative, and the two
+        # stacks merge into nodes with both parents, which exploring each
+        # alternative's stacks on their own never reaches.
+        tokenizer = ToyLlamaTokenizer()
+        input_text = 'root ::= "a" z "c" | "a" "b" z "x"\nz ::= "b" z "(" | "b"\n'
+        grammar = GrammarSampler(input_text, "root", tokenizer, metrics=Metrics())
+        grammar.precompile(workers=0)
+        self.assertGreater(self.computed(grammar), 0)
+        grammar.metrics.reset()
+        self.generate_masks(grammar, [1] + tokenizer.encode("abb("))
+        self.assertEqual(self.computed(grammar), 0)
+
+    def test_publish_and_attach(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        ids = [1] + tokenizer.encode("t(ab: #ff")
+
+        with tempfile.TemporaryDirectory() as shared_dir:
+            grammar = GrammarSampler(input_text, "root", tokenizer)
+            expected = self.generate_masks(grammar, ids)
+            grammar.publish("dsl", shared_dir)
+
+            first = GrammarSampler.attach("dsl", shared_dir, metrics=Metrics())
+            self.assertFalse(first.token_trie.node_bytes.flags.writeable)
+            for mask, expected_mask in zip(self.generate_masks(first, ids), expected):
+                self.assertTrue(torch.equal(mask, expected_mask))
+            # the publisher's masks were published with the grammar
+            self.assertEqual(self.computed(first), 0)
+            other_ids = [1] + tokenizer.encode("info(abc)")
+            self.generate_masks(first, other_ids)
+            self.assertGreater(self.computed(first), 0)
+
+            # masks computed by one attached sampler are shared with the rest
+            second = GrammarSampler.attach("dsl", shared_dir, metrics=Metrics())
+            self.generate_masks(second, ids)
+            self.generate_masks(second, other_ids)
+            self.assertEqual(self.computed(second), 0)
+
+            with self.assertRaises(FileNotFoundError):
+                GrammarSampler.attach("missing", shared_dir)
+
+    def test_publish_replaces_a_stale_grammar(self):
+        tokenizer = ToyLlamaTokenizer()
+        vocab = tokenizer.get_vocab()
+        vocab_size = len(vocab)
+
+        def allowed(grammar):
+            processor = grammar.logits_processor()
+            scores = processor([[1]], torch.zeros((1, vocab_size)))
+            return torch.isfinite(scores[0]).nonzero().flatten().tolist()
+
+        with tempfile.TemporaryDirectory() as shared_dir:
+            old = GrammarSampler('root ::= "a"+\n', "root", tokenizer)
+            old.publish("dsl", shared_dir)
+            self.assertEqual(allowed(old), [vocab["a"]])
+
+            # a later deploy publishes a different grammar under the same name
+            new = GrammarSampler('root ::= "b"+\n', "root", tokenizer)
+            new.publish("dsl", shared_dir)
+            self.assertEqual(allowed(new), [vocab["b"]])
+            attached = GrammarSampler.attach("dsl", shared_dir, key=new.grammar_key())
+            self.assertEqual(allowed(attached), [vocab["b"]])
+
+            with self.assertRaises(RuntimeError):
+                GrammarSampler.attach("dsl", shared_dir, key=old.grammar_key())
+
+    def test_mask_file_is_remapped_only_when_outgrown(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "masks.bin")
+            writer = MaskFile(path, 2)
+            reader = MaskFile(path, 2)
+            mappings = []
+            for n in range(4 * MIN_RECORDS + 1):
+                key = n.to_bytes(16, "little")
+                writer.add(key, [n, 2**64 - 1 - n])
+                self.assertEqual(reader.get(key).tolist(), [n, 2**64 - 1 - n])
+                if not mappings or reader.rows is not mappings[-1]:
+                    mappings.append(reader.rows)
+            self.assertEqual(len(reader), 4 * MIN_RECORDS + 1)
+            # the file doubles in size whenever it's full
+            self.assertEqual(
+                [len(rows) for rows in mappings],
+                [MIN_RECORDS, 2 * MIN_RECORDS, 4 * MIN_RECORDS, 8 * MIN_RECORDS],
+            )
+            self.assertIsNone(reader.get(b"\xff" * 16))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+from torch_grammar import GrammarSampler
+from torch_grammar.grammar_optimizer import optimize
+from torch_grammar.grammar_parser import parse
+from torch_grammar.masks import unpack
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestGrammarOptimizer(unittest.TestCase):
+    def test_passes(self):
+        state = parse(
+            'root ::= "ab" x | "ab" "c" | "ab" | [0-9]* "." [0-9]*\n'
+            'x ::= "x" | "y" | [a-c]\n'
+            'unused ::= "z"\n'
+        )
+        optimized, report = optimize(state, state.symbol_ids["root"])
+        removed = report["passes"]
+        self.assertEqual(removed["unreachable"], {"rules": 1, "positions": 1})
+        # x becomes [a-cx-y], and then absorbs "c" once inlined
+        self.assertEqual(removed["merge_chars"], {"rules": 0, "positions": 3})
+        # the rules generated for the two [0-9]* are identical
+        self.assertEqual(removed["dedup"], {"rules": 1, "positions": 2})
+        self.assertEqual(removed["inline"], {"rules": 1, "positions": 1})
+        # "a" "b" is shared by three alternatives
+        self.assertEqual(removed["left_factor"], {"rules": -1, "positions": 3})
+        self.assertEqual(report["before"], {"rules": 5, "positions": 19})
+        self.assertEqual(report["after"], {"rules": 3, "positions": 9})
+        self.assertEqual(set(optimized.symbol_ids), {"root", "root_2", "root_5"})
+
+    def test_optimized_grammar_accepts_the_same_tokens(self):
+        tokenizer = ToyLlamaTokenizer()
+        vocab_size = len(tokenizer.get_vocab())
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        plain = GrammarSampler(input_text, "root", tokenizer, optimize=False)
+        optimized = GrammarSampler(input_text, "root", tokenizer)
+        self.assertLess(
+            optimized.optimization_report["after"]["positions"],
+            optimized.optimization_report["before"]["positions"],
+        )
+
+        ids = tokenizer.encode('t(x: #ff12ff)\ninfo(abc)\nnav("/a/b")\n')
+        plain_state = plain.init_state()
+        optimized_state = optimized.init_state()
+        for token in ids:
+            np.testing.assert_array_equal(
+                unpack(plain.state_acceptance(plain_state), vocab_size),
+                unpack(optimized.state_acceptance(optimized_state), vocab_size),
+            )
+            plain_state = plain.next_state(plain_state, token)
+            optimized_state = optimized.next_state(optimized_state, token)
@@ -0,0 +1,42 @@
+import unittest
+from torch_grammar import GrammarSyntaxError
+from torch_grammar.grammar_parser import parse
+
+
+class TestGrammarParser(unittest.TestCase):
+    def test_literals_ranges_and_repetition(self):
+        state = parse('root ::= "ab" [0-9x]*\n')
+        self.assertEqual(state.symbol_ids, {"root": 0, "root_1": 1})
+        # root_1 ::= [0-9x] root_1 |
+        # root ::= "a" "b" root_1
+        self.assertEqual(state.out_grammar, [
+            1, 8, 4, 48, 57, 120, 120, 1, 1, 0, 1, 0, 0,
+            0, 9, 2, 97, 97, 2, 98, 98, 1, 1, 0, 0,
+            0xFFFF,
+        ])  # fmt: skip
+
+    def test_escapes_and_missing_trailing_newline(self):
+        state = parse(r'root ::= "\x41\n" [\x30-\x39]')
+        self.assertEqual(
+            state.out_grammar, [0, 10, 2, 65, 65, 2, 10, 10, 2, 48, 57, 0, 0, 0xFFFF]
+        )
+
+    def test_syntax_errors(self):
+        cases = [
+            ('root ::= "abc', 1, 14),
+            ('root ::= x\nfoo = "y"\n', 2, 5),
+            ("root ::= (a\n", 2, 1),
+            ("root ::= *\n", 1, 10),
+            ('root ::= "\\q"\n', 1, 11),
+        ]
+        for src, line, column in cases:
+            with self.subTest(src=src):
+                with self.assertRaises(GrammarSyntaxError) as context:
+                    parse(src)
+                error = context.exception
+                self.assertEqual((error.line, error.column), (line, column))
+                self.assertIn(f"line {line}, column {column}", str(error))
+
+
+if __name__ == "__main__":
+    unittest.main()
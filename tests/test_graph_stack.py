@@ -0,0 +1,46 @@
+import unittest
+from torch_grammar import GrammarSampler
+from torch_grammar.graph_stack import EMPTY, depth, digest, linearize, merge
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestGraphStack(unittest.TestCase):
+    def test_merge_unions_parents_of_equal_tops(self):
+        bottom = frozenset([EMPTY])
+        a = (7, bottom)
+        b = (9, bottom)
+        merged = merge([(3, frozenset([a])), (3, frozenset([b])), EMPTY])
+        self.assertEqual(merged, frozenset([(3, frozenset([a, b])), EMPTY]))
+        (top,) = [stack for stack in merged if stack]
+        self.assertEqual(sorted(linearize(top)), [[7, 3], [9, 3]])
+        self.assertEqual(depth(top), 2)
+
+    def test_digest_ignores_order_and_handles_deep_stacks(self):
+        bottom = frozenset([EMPTY])
+        a = (7, bottom)
+        b = (9, bottom)
+        self.assertEqual(digest((3, frozenset([a, b]))), digest((3, frozenset([b, a]))))
+        self.assertNotEqual(digest((3, frozenset([a]))), digest((3, frozenset([b]))))
+
+        stack = EMPTY
+        for pos in range(5000):
+            stack = (pos % 7, frozenset([stack]))
+        self.assertEqual(len(digest(stack)), 16)
+
+    def test_ambiguous_grammar_stays_linear(self):
+        # Every "a" can either open a pending "b" or not, so a list of linear
+        # stacks doubles with each byte.
+        tokenizer = ToyLlamaTokenizer()
+        grammar = GrammarSampler(
+            'root ::= x\nx ::= "a" x "b" | "a" x | "c"\n', "root", tokenizer
+        )
+        a = tokenizer.get_vocab()["a"]
+        stacks = grammar.init_stacks()
+        for _ in range(64):
+            stacks = grammar.accept_token(a, stacks)
+        self.assertLessEqual(len(stacks), 3)
+        self.assertEqual(max(depth(stack) for stack in stacks), 65)
+
+
+if __name__ == "__main__":
+    unittest.main()
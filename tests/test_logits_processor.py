@@ -0,0 +1,269 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from torch_grammar import GrammarSampler
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestLogitsProcessor(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        self.grammar = GrammarSampler(input_text, "root", self.tokenizer)
+        self.vocab_size = len(self.tokenizer.get_vocab())
+
+    def single_row_mask(self, ids):
+        processor = self.grammar.logits_processor()
+        for n in range(1, len(ids) + 1):
+            scores = processor([ids[:n]], torch.zeros((1, self.vocab_size)))
+        return torch.isfinite(scores[0])
+
+    def test_batched_rows_match_single_rows(self):
+        encode = self.tokenizer.encode
+        rows = [
+            [1] + encode('nav("/ab'),
+            [1] + encode("info(abc"),
+            [1] + encode("t(x: #ff"),
+        ]
+        processor = self.grammar.logits_processor(batch_size=len(rows))
+        for n in range(1, min(len(r) for r in rows) + 1):
+            scores = torch.zeros((len(rows), self.vocab_size))
+            scores = processor([r[:n] for r in rows], scores)
+
+        for row, ids in enumerate(rows):
+            expected = self.single_row_mask(ids[: min(len(r) for r in rows)])
+            self.assertTrue(torch.equal(torch.isfinite(scores[row]), expected))
+
+    def test_rows_join_and_finish(self):
+        encode = self.tokenizer.encode
+        eos = self.tokenizer.eos_token_id
+        first = [1] + encode("info(abc)\n") + [eos]
+        processor = self.grammar.logits_processor()
+        for n in range(1, len(first) + 1):
+            processor([first[:n]], torch.zeros((1, self.vocab_size)))
+
+        # A second row joins after the first one has finished.
+        self.assertEqual(processor.add_rows(), [1])
+        second = [1]
+        first.append(0)
+        scores = processor([first, second], torch.zeros((2, self.vocab_size)))
+        self.assertTrue(torch.isfinite(scores[0]).all())
+        self.assertTrue(
+            torch.equal(torch.isfinite(scores[1]), self.single_row_mask([1]))
+        )
+
+        processor.remove_rows([0])
+        second = second + encode("info(")
+        with self.assertRaises(RuntimeError):
+            processor([first, second], torch.zeros((2, self.vocab_size)))
+
+    def test_states_are_interned(self):
+        encode = self.tokenizer.encode
+        grammar = self.grammar
+        state = grammar.init_state()
+        line_ends = []
+        for line in ["info(abc)\n", "info(ab)\n", "info(abc)\n"]:
+            for token in encode(line):
+                state = grammar.next_state(state, token)
+            line_ends.append(state)
+
+        self.assertEqual(len(set(line_ends)), 1)
+        # the third line replays transitions that are already in the table
+        self.assertGreaterEqual(grammar.cache_stats()["next_state"]["hits"], 3)
+
+    def test_jump_forward(self):
+        encode = self.tokenizer.encode
+        processor = self.grammar.logits_processor()
+        ids = [1] + encode("nav")
+        for n in range(1, len(ids) + 1):
+            processor([ids[:n]], torch.zeros((1, self.vocab_size)))
+
+        # `("/` is the only way to continue `nav`
+        forced = processor.jump_forward()
+        self.assertEqual(forced, encode('("/'))
+        self.assertEqual(processor.jump_forward(), [])
+        ids += forced
+        scores = processor([ids], torch.zeros((1, self.vocab_size)))
+        self.assertTrue(
+            torch.equal(torch.isfinite(scores[0]), self.single_row_mask(ids))
+        )
+
+    def test_verify_draft_and_roll_back(self):
+        encode = self.tokenizer.encode
+        prefix = [1] + encode("info(")
+        processor = self.grammar.logits_processor()
+        for n in range(1, len(prefix) + 1):
+            processor([prefix[:n]], torch.zeros((1, self.vocab_size)))
+
+        # `(` can't follow `info(abc`
+        draft = encode("ab") + encode("c") + encode("(")
+        scores = torch.zeros((len(draft) + 1, self.vocab_size))
+        n, _ = processor.verify(draft, scores=scores)
+        self.assertEqual(n, 2)
+        for i in range(n + 1):
+            expected = self.single_row_mask(prefix + draft[:i])
+            self.assertTrue(torch.equal(torch.isfinite(scores[i]), expected))
+        self.assertTrue(torch.isfinite(scores[n + 1]).all())
+
+        # Input may grow by several tokens at once, and shrink again.
+        ids = prefix + draft[:n] + encode(")")
+        scores = processor([ids], torch.zeros((1, self.vocab_size)))
+        self.assertTrue(
+            torch.equal(torch.isfinite(scores[0]), self.single_row_mask(ids))
+        )
+        scores = processor([prefix + draft[:1]], torch.zeros((1, self.vocab_size)))
+        self.assertTrue(
+            torch.equal(
+                torch.isfinite(scores[0]), self.single_row_mask(prefix + draft[:1])
+            )
+        )
+        with self.assertRaises(RuntimeError):
+            processor([[]], torch.zeros((1, self.vocab_size)))
+
+    def test_replaced_tokens_roll_back_to_common_prefix(self):
+        encode = self.tokenizer.encode
+        prefix = [1] + encode("info(")
+        processor = self.grammar.logits_processor()
+        for n in range(1, len(prefix) + 1):
+            processor([prefix[:n]], torch.zeros((1, self.vocab_size)))
+
+        def check(ids):
+            scores = processor(torch.tensor([ids]), torch.zeros((1, self.vocab_size)))
+            expected = self.single_row_mask(ids)
+            self.assertTrue(torch.equal(torch.isfinite(scores[0]), expected))
+
+        # a rejected draft token replaced by the target's at the same length
+        check(prefix + encode("ab"))
+        check(prefix + encode("_"))
+        # shrink, then grow past the old length with different tokens
+        check(prefix + encode("_") + encode("ab"))
+        check(prefix + encode("c") + encode("_") + encode("x"))
+        # a token accepted by advance() and then replaced
+        processor.advance(encode(")"))
+        check(prefix + encode("c") + encode("_") + encode("ab"))
+        # tokens accepted by jump_forward() and kept
+        check([1] + encode("nav"))
+        forced = processor.jump_forward()
+        self.assertEqual(forced, encode('("/'))
+        check([1] + encode("nav") + forced + encode("ab"))
+
+    def test_fork_reorder_and_restore(self):
+        encode = self.tokenizer.encode
+        processor = self.grammar.logits_processor()
+        prefix = [1] + encode("info(")
+        for n in range(1, len(prefix) + 1):
+            processor([prefix[:n]], torch.zeros((1, self.vocab_size)))
+        self.assertEqual(processor.fork([0, 0]), [1, 2])
+        snapshot = processor.snapshot()
+
+        beams = [prefix + encode("ab"), prefix + encode("_"), prefix + encode("c")]
+        processor(beams, torch.zeros((3, self.vocab_size)))
+        # beam search keeps beams 2 and 0, and 2 twice
+        processor.reorder([2, 0, 2])
+        beams = [beams[2], beams[0], beams[2] + encode("ab")]
+        scores = processor(beams, torch.zeros((3, self.vocab_size)))
+        for row, ids in enumerate(beams):
+            expected = self.single_row_mask(ids)
+            self.assertTrue(torch.equal(torch.isfinite(scores[row]), expected))
+
+        processor.restore(snapshot)
+        self.assertEqual(processor.states, [processor.states[0]] * 3)
+        scores = processor([prefix] * 3, torch.zeros((3, self.vocab_size)))
+        self.assertTrue(
+            torch.equal(torch.isfinite(scores[2]), self.single_row_mask(prefix))
+        )
+
+    def test_top_k_matches_full_mask_for_greedy_decoding(self):
+        torch.manual_seed(0)
+        full = self.grammar.logits_processor()
+        lazy = self.grammar.logits_processor(top_k=4)
+        ids = [1]
+        for _ in range(20):
+            scores = torch.randn((1, self.vocab_size))
+            token = torch.argmax(full([ids], scores.clone())).item()
+            self.assertEqual(torch.argmax(lazy([ids], scores.clone())).item(), token)
+            if token == self.tokenizer.eos_token_id:
+                break
+            ids = ids + [token]
+
+    def test_async_masks_match_sync_masks(self):
+        torch.manual_seed(0)
+        sync = self.grammar.logits_processor()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            overlapped = self.grammar.logits_processor(executor=executor)
+            ids = [1]
+            for _ in range(20):
+                scores = torch.randn((1, self.vocab_size))
+                expected = sync([ids], scores.clone())
+                # the pending masks are used for every call after the first
+                self.assertEqual(overlapped.pending is None, len(ids) == 1)
+                actual = overlapped([ids], scores.clone())
+                self.assertTrue(torch.equal(actual, expected))
+                token = torch.argmax(actual).item()
+                if token == self.tokenizer.eos_token_id:
+                    break
+                ids = ids + [token]
+                overlapped.advance([token])
+
+    def test_async_masks_with_several_workers(self):
+        # Two batched processors share one grammar (and its caches, kept
+        # small so that entries are evicted) and a multi-worker executor.
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        grammar = GrammarSampler(
+            input_text, "root", self.tokenizer, host_cache_bytes=20000
+        )
+        # Record any mask computation that runs alongside another one; the
+        # sleep leaves the caller's thread time to get in.
+        state_acceptance = grammar.state_acceptance
+        active = []
+        overlapped = []
+
+        def checked_state_acceptance(state):
+            active.append(state)
+            overlapped.append(len(active) > 1)
+            time.sleep(0.001)
+            try:
+                return state_acceptance(state)
+            finally:
+                active.remove(state)
+
+        grammar.state_acceptance = checked_state_acceptance
+        eos = self.tokenizer.eos_token_id
+        generator = torch.Generator().manual_seed(0)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            processors = [
+                grammar.logits_processor(batch_size=3, executor=executor)
+                for _ in range(2)
+            ]
+            rows = [[[1] for _ in range(3)] for _ in processors]
+            for step in range(30):
+                for processor, ids in zip(processors, rows):
+                    scores = torch.randn((3, self.vocab_size), generator=generator)
+                    scores = processor(ids, scores)
+                    for row in range(3):
+                        expected = self.single_row_mask(ids[row])
+                        self.assertTrue(
+                            torch.equal(torch.isfinite(scores[row]), expected)
+                        )
+                    tokens = torch.argmax(scores, dim=-1).tolist()
+                    tokens = [
+                        eos if ids[r][-1] == eos else t for r, t in enumerate(tokens)
+                    ]
+                    for row, token in enumerate(tokens):
+                        ids[row].append(token)
+                    processor.advance(tokens)
+                    allowed = torch.isfinite(scores[0]).nonzero().flatten().tolist()
+                    if step % 5 == 4 and len(allowed) > 1:
+                        # the caller replaces a token after advance(), so the
+                        # pending masks are for the wrong states
+                        allowed.remove(tokens[0])
+                        ids[0][-1] = allowed[0]
+        self.assertTrue(overlapped)
+        self.assertFalse(any(overlapped))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+import torch
+from torch_grammar.masks import MaskTable, num_words, pack, unpack, unpack_tensor
+
+
+class TestMasks(unittest.TestCase):
+    def test_table_grows_and_keeps_rows(self):
+        vocab_size = 100
+        rng = np.random.default_rng(0)
+        masks = {key: rng.random(vocab_size) < 0.5 for key in range(40)}
+        table = MaskTable(num_words(vocab_size), "cpu", capacity=4)
+        lookups = []
+
+        def lookup(key):
+            lookups.append(key)
+            return pack(masks[key])
+
+        for start in range(0, 40, 8):
+            rows = table.index(list(range(start, start + 8)) + [None, 0], lookup)
+            bits = unpack_tensor(table.gather(rows), vocab_size)
+            for key, row_bits in zip(list(range(start, start + 8)), bits):
+                self.assertTrue(np.array_equal(row_bits.numpy(), masks[key]))
+            self.assertTrue(bits[-2].all())
+        self.assertEqual(sorted(lookups), list(range(40)))
+        self.assertGreaterEqual(len(table.words), 41)
+
+    def test_table_reuses_least_recently_used_rows(self):
+        vocab_size = 100
+        rng = np.random.default_rng(0)
+        masks = {key: rng.random(vocab_size) < 0.5 for key in range(10)}
+        table = MaskTable(num_words(vocab_size), "cpu", max_rows=4)
+
+        def lookup(key):
+            return pack(masks[key])
+
+        table.index([0, 1], lookup)
+        table.index([2], lookup)
+        table.index([0], lookup)
+        # keys 1 and 2 are the least recently used; row 0 (None) always stays
+        table.index([3, 4], lookup)
+        self.assertEqual(set(table.rows), {None, 0, 3, 4})
+        self.assertEqual(table.evictions, 2)
+        self.assertEqual(len(table.words), 4)
+        # a batch bigger than the table still fits
+        rows = table.index([5, 6, 7, 8, 9], lookup)
+        bits = unpack_tensor(table.gather(rows), vocab_size)
+        for key, row_bits in zip(range(5, 10), bits):
+            self.assertTrue(np.array_equal(row_bits.numpy(), masks[key]))
+
+    def test_pack_round_trip(self):
+        accepts = np.arange(130) % 3 == 0
+        words = pack(accepts)
+        self.assertEqual(len(words), 3)
+        self.assertTrue(np.array_equal(unpack(words, 130), accepts))
+        tensor = torch.from_numpy(words.view(np.int64))
+        self.assertTrue(np.array_equal(unpack_tensor(tensor, 130).numpy(), accepts))
@@ -0,0 +1,58 @@
+import unittest
+import torch
+from torch_grammar import GrammarSampler, Metrics
+from torch_grammar.metrics import Histogram
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [0.0, 1.0, 2.0, 3.0, 100.0]:
+            histogram.observe(value)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 5)
+        self.assertEqual(summary["sum"], 106.0)
+        self.assertEqual(summary["max"], 100.0)
+        # quantiles are power-of-two bucket bounds
+        self.assertEqual(summary["p50"], 4.0)
+        self.assertEqual(summary["p99"], 100.0)
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_sampler_reports_metrics(self):
+        tokenizer = ToyLlamaTokenizer()
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        metrics = Metrics()
+        grammar = GrammarSampler(input_text, "root", tokenizer, metrics=metrics)
+        processor = grammar.logits_processor()
+        ids = [1] + tokenizer.encode("info(abc)\n")
+        for n in range(1, len(ids) + 1):
+            processor([ids[:n]], torch.zeros((1, len(tokenizer.get_vocab()))))
+
+        summary = metrics.summary()
+        self.assertGreater(summary["counters"]["masks_computed"], 0)
+        histograms = summary["histograms"]
+        self.assertEqual(histograms["filter_logits_seconds"]["count"], len(ids))
+        self.assertEqual(histograms["stacks"]["count"], len(ids))
+        self.assertGreaterEqual(histograms["stack_depth"]["max"], 1)
+        for name in ("advance_stack_seconds", "upload_seconds"):
+            self.assertGreater(histograms[name]["count"], 0)
+
+        stats = grammar.cache_stats()
+        self.assertGreater(stats["next_state"]["misses"], 0)
+        self.assertGreater(stats["mask_table[cpu]"]["size"], 1)
+
+    def test_deeply_nested_stacks(self):
+        tokenizer = ToyLlamaTokenizer()
+        metrics = Metrics()
+        grammar = GrammarSampler(
+            'root ::= x\nx ::= "(" x ")" | "a"\n', "root", tokenizer, metrics=metrics
+        )
+        processor = grammar.logits_processor()
+        ids = [1] + tokenizer.encode("(" * 2000)
+        vocab_size = len(tokenizer.get_vocab())
+        processor([ids[:1]], torch.zeros((1, vocab_size)))
+        # all at once, so no shallower stack was measured first
+        processor([ids], torch.zeros((1, vocab_size)))
+        self.assertEqual(metrics.summary()["histograms"]["stack_depth"]["max"], 2001)
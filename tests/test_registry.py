@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import torch
+from torch_grammar import GrammarRegistry, GrammarSampler, Metrics
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class TestGrammarRegistry(unittest.TestCase):
+    def setUp(self):
+        with open("examples/grammar.ebnf", "r") as file:
+            self.input_text = file.read()
+
+    def test_grammars_share_one_trie_and_are_deduplicated(self):
+        tokenizer = ToyLlamaTokenizer()
+        metrics = Metrics()
+        registry = GrammarRegistry(tokenizer, metrics=metrics)
+
+        root = registry.get(self.input_text, "root")
+        info = registry.get(self.input_text, "info")
+        self.assertIs(root.token_trie, registry.token_trie)
+        self.assertIs(info.token_trie, registry.token_trie)
+        self.assertIsNot(root, info)
+        self.assertIs(registry.get(self.input_text, "root"), root)
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(metrics.counters["grammars_compiled"], 2)
+        self.assertEqual(metrics.counters["grammars_reused"], 1)
+
+        # masks match a sampler with a trie of its own
+        ids = [1] + tokenizer.encode("t(ab: #ff")
+        vocab_size = len(registry.token_trie)
+        standalone = GrammarSampler(self.input_text, "root", tokenizer)
+        shared_processor = root.logits_processor()
+        processor = standalone.logits_processor()
+        for n in range(1, len(ids) + 1):
+            expected = processor([ids[:n]], torch.zeros((1, vocab_size)))
+            scores = shared_processor([ids[:n]], torch.zeros((1, vocab_size)))
+            self.assertTrue(torch.equal(scores, expected))
+
+    def test_cached_grammars_share_one_trie(self):
+        tokenizer = ToyLlamaTokenizer()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = GrammarRegistry(tokenizer, cache_dir=cache_dir)
+            first.get(self.input_text, "root")
+            first.get(self.input_text, "info")
+
+            # a second process loads both grammars from the cache
+            second = GrammarRegistry(tokenizer, cache_dir=cache_dir)
+            for start_rule_name in ("root", "info"):
+                grammar = second.get(self.input_text, start_rule_name)
+                self.assertIs(grammar.token_trie, second.token_trie)
+
+            # and the trie is stored once, not per grammar
+            vocabs = [name for name in os.listdir(cache_dir) if "vocab" in name]
+            self.assertEqual(len(vocabs), 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_least_recently_used_grammars_are_evicted(self):
+        registry = GrammarRegistry(ToyLlamaTokenizer(), max_grammars=2)
+        root = registry.get(self.input_text, "root")
+        registry.get(self.input_text, "info")
+        registry.get(self.input_text, "root")
+        registry.get(self.input_text, "nav")
+        self.assertIn((self.input_text, "root"), registry)
+        self.assertIn((self.input_text, "nav"), registry)
+        self.assertNotIn((self.input_text, "info"), registry)
+        self.assertIs(registry.get(self.input_text, "root"), root)
+
+        registry.remove(self.input_text, "nav")
+        self.assertEqual(len(registry), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import numpy as np
+from torch_grammar import GrammarSampler
+from torch_grammar.grammar_parser import parse
+from torch_grammar.masks import pack
+from torch_grammar.regular import RegularRules, build_dfa, byte_classes
+from torch_grammar.regular import regular_rule_ids
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+GRAMMAR = r"""root ::= item
+item ::= "(" item ")" | "/" list "/" | string
+list ::= string (": " string)*
+string ::= "\"" [a-z ]* "\""
+"""
+
+
+class TestRegular(unittest.TestCase):
+    def test_regular_rules(self):
+        state = parse(GRAMMAR)
+        rules = GrammarSampler.find_rules(state.out_grammar)
+        names = {rule_id: name for name, rule_id in state.symbol_ids.items()}
+        regular = {names[r] for r in regular_rule_ids(state.out_grammar, rules)}
+        # item nests itself; the rest (including the generated repetition
+        # rules) are regular.
+        self.assertEqual(regular, {"list", "list_4", "list_5", "string", "string_6"})
+
+    def test_dfa_is_minimal(self):
+        state = parse('root ::= [0-9] [0-9]* | [0-9]+ "." [0-9]+\n')
+        rules = GrammarSampler.find_rules(state.out_grammar)
+        delta, accepting = build_dfa(state.out_grammar, rules, 0)
+        # start, integer part, after ".", fraction
+        self.assertEqual(accepting.tolist(), [False, True, False, True])
+        self.assertEqual(delta[0, ord("5")], 1)
+        self.assertEqual(delta[1, ord(".")], 2)
+        self.assertEqual(delta[0, ord(".")], -1)
+
+    def test_dfa_over_byte_classes(self):
+        state = parse(GRAMMAR)
+        src = state.out_grammar
+        rules = GrammarSampler.find_rules(src)
+        classes = byte_classes(src, rules)
+        # `(`, `)`, `/`, `"`, `:`, ` `, [a-z] and everything else
+        self.assertEqual(classes.max() + 1, 8)
+        self.assertEqual(classes[ord("a")], classes[ord("z")])
+        # the same DFAs as when every byte is a class of its own
+        for rule_id in regular_rule_ids(src, rules):
+            dfa = build_dfa(src, rules, rule_id, classes=classes)
+            expected = build_dfa(src, rules, rule_id, classes=np.arange(256))
+            for array, expected_array in zip(dfa, expected):
+                np.testing.assert_array_equal(array, expected_array)
+
+    def test_start_and_large_rules_are_left_to_the_pda(self):
+        state = parse('root ::= list\nlist ::= "[" [0-9]+ ("," [0-9]+)* "]"\n')
+        src = state.out_grammar
+        rules = GrammarSampler.find_rules(src)
+        ids = state.symbol_ids
+        regular = RegularRules(src, rules, ids["root"])
+        self.assertIsNone(regular.start(ids["root"]))
+        self.assertIsNotNone(regular.start(ids["list"]))
+        small = RegularRules(src, rules, ids["root"], max_positions=4)
+        self.assertIsNone(small.start(ids["list"]))
+        self.assertEqual(small.dfas, {ids["list"]: None})
+
+    def test_dfa_masks_match_trie_traversal(self):
+        tokenizer = ToyLlamaTokenizer()
+        grammar = GrammarSampler(GRAMMAR, "root", tokenizer, optimize=False)
+        ids = tokenizer.encode('(/"abc ab": "c"/)')
+        state = grammar.init_state()
+        checked = 0
+        for token in ids:
+            for stack in grammar.states[state]:
+                if not stack or not grammar.regular.is_virtual(stack[0]):
+                    continue
+                accepts = np.zeros(len(grammar.token_trie), dtype=bool)
+                accepted = grammar.token_trie.traverse([stack], grammar.accept)
+                accepts[accepted] = True
+                accepts[grammar.eos_token_id] = False
+                np.testing.assert_array_equal(
+                    grammar.compute_token_acceptance(stack), pack(accepts)
+                )
+                checked += 1
+            state = grammar.next_state(state, token)
+        self.assertGreater(checked, 5)
+
+    def test_class_loop_masks_match_trie_traversal(self):
+        tokenizer = ToyLlamaTokenizer()
+        # `[a-z ] item` loops, but item nests itself so it has no DFA
+        grammar = GrammarSampler(
+            'root ::= item\nitem ::= [a-z ] item | "(" item ")" item | ""\n',
+            "root",
+            tokenizer,
+        )
+        state = grammar.init_state()
+        checked = 0
+        for token in tokenizer.encode("ab(c)ab"):
+            state = grammar.next_state(state, token)
+            for stack in grammar.states[state]:
+                if grammar.loop_successors(stack) is None:
+                    continue
+                accepts = np.zeros(len(grammar.token_trie), dtype=bool)
+                accepted = grammar.token_trie.traverse([stack], grammar.accept)
+                accepts[accepted] = True
+                accepts[grammar.eos_token_id] = not stack
+                np.testing.assert_array_equal(
+                    grammar.compute_token_acceptance(stack), pack(accepts)
+                )
+                checked += 1
+        self.assertGreater(checked, 3)
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from torch_grammar import GrammarSampler
+from torch_grammar.token_trie import TokenTrie, bytes_to_unicode
+from tests.toy_tokenizer import ToyLlamaTokenizer
+
+
+class ToyGPT2Tokenizer:
+    eos_token_id = 0
+    additional_special_tokens_ids = [1]
+
+    def __init__(self):
+        chars = bytes_to_unicode()
+        self.tokens = ["<|endoftext|>", "<|pad|>"]
+        self.tokens += [chars[b] for b in range(256)]
+        self.tokens += ["".join(chars[b] for b in " hello".encode())]
+        self.tokens += ["".join(chars[b] for b in "é".encode())]
+
+    def get_vocab(self):
+        return {token: i for i, token in enumerate(self.tokens)}
+
+
+class TestTokenTrie(unittest.TestCase):
+    def test_llama_tokens(self):
+        trie = TokenTrie(ToyLlamaTokenizer())
+        vocab = ToyLlamaTokenizer().get_vocab()
+        self.assertEqual(trie.id2str(vocab["<0x0A>"]), b"\n")
+        self.assertEqual(trie.id2str(vocab["<0xC3>"]), b"\xc3")
+        self.assertEqual(trie.id2str(vocab[":▁"]), b": ")
+
+    def test_gpt2_tokens(self):
+        trie = TokenTrie(ToyGPT2Tokenizer())
+        self.assertEqual(trie.id2str(0), b"<|endoftext|>")
+        self.assertIsNone(trie.id2str(1))
+        self.assertEqual(trie.id2str(2 + 0x80), b"\x80")
+        self.assertEqual(trie.id2str(258), b" hello")
+        self.assertEqual(trie.id2str(259), "é".encode())
+
+    def test_save_and_load(self):
+        tokenizer = ToyLlamaTokenizer()
+        trie = TokenTrie(tokenizer)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "vocab.npz")
+            trie.save(path)
+            loaded = TokenTrie.load(path)
+        self.assertEqual(loaded.tokens, trie.tokens)
+        self.assertEqual(loaded.fingerprint(), trie.fingerprint())
+
+        with open("examples/grammar.ebnf", "r") as file:
+            input_text = file.read()
+        expected = GrammarSampler(input_text, "root", tokenizer)
+        grammar = GrammarSampler(input_text, "root", loaded)
+        state = grammar.init_state()
+        expected_state = expected.init_state()
+        for token in tokenizer.encode("info(abc)\n"):
+            self.assertTrue(
+                (
+                    grammar.state_acceptance(state)
+                    == expected.state_acceptance(expected_state)
+                ).all()
+            )
+            state = grammar.next_state(state, token)
+            expected_state = expected.next_state(expected_state, token)
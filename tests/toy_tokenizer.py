@@ -0,0 +1,62 @@
+# A tiny SentencePiece-style vocabulary that can be used without downloading
+# a real tokenizer. The class name matters: TokenTrie picks its token
+# formatting based on it.
+class ToyLlamaTokenizer:
+    eos_token_id = 2
+    bos_token_id = 1
+
+    PIECES = [
+        "info(",
+        'nav("/',
+        "t(",
+        '")',
+        ")",
+        "\n",
+        ")\n",
+        "#",
+        '"',
+        ":▁",
+        "true",
+        "false",
+        "▁",
+        "_",
+        "/",
+        "abc",
+        "ab",
+        "a",
+        "b",
+        "c",
+        "x",
+        "ff",
+        "0",
+        "12",
+        "▁color",
+        "info",
+        "nav",
+        "(",
+    ]
+
+    def __init__(self):
+        self.tokens = ["<unk>", "<s>", "</s>"]
+        self.tokens += ["<0x%02X>" % i for i in range(256)]
+        self.tokens += self.PIECES
+
+    def convert_ids_to_tokens(self, token_id):
+        return self.tokens[token_id]
+
+    def get_vocab(self):
+        return {token: i for i, token in enumerate(self.tokens)}
+
+    def encode(self, text):
+        ids = []
+        vocab = self.get_vocab()
+        while text:
+            for n in range(len(text), 0, -1):
+                piece = text[:n].replace(" ", "▁")
+                if piece in vocab:
+                    ids.append(vocab[piece])
+                    text = text[n:]
+                    break
+            else:
+                raise ValueError(f"cannot encode {text!r}")
+        return ids
@@ -1,3 +1,6 @@
 from .grammar_sampler import GrammarSampler
+from .grammar_parser import GrammarSyntaxError
+from .metrics import Metrics
+from .registry import GrammarRegistry
 
-__all__ = ["GrammarSampler"]
+__all__ = ["GrammarSampler", "GrammarSyntaxError", "Metrics", "GrammarRegistry"]
@@ -0,0 +1,44 @@
+import torch
+
+
+# A handle on a batch of packed masks being computed in the background. The
+# words are written to a host buffer, pinned when CUDA is available, so that
+# result() can start a non-blocking copy to the device.
+class MaskFuture:
+    def __init__(self, future, states, buffer):
+        self.future = future
+        self.states = states
+        self.buffer = buffer
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self):
+        self.future.result()
+
+    # Wait for the masks and return them on `device` as (rows, num_words)
+    # int64 words.
+    def result(self, device):
+        self.future.result()
+        return self.buffer.to(device, non_blocking=True)
+
+
+# Alternates between two host buffers per shape, so a buffer is never
+# rewritten while the previous step's copy out of it may still be in flight.
+class HostBuffers:
+    def __init__(self):
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.turn = 0
+
+    def get(self, rows, num_words):
+        pair = self.buffers.get((rows, num_words))
+        if pair is None:
+            pair = self.buffers[(rows, num_words)] = [
+                torch.empty(
+                    (rows, num_words), dtype=torch.int64, pin_memory=self.pin_memory
+                )
+                for _ in range(2)
+            ]
+        self.turn ^= 1
+        return pair[self.turn]
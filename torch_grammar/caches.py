@@ -0,0 +1,181 @@
+# Per-sampler memoization with a shared byte budget.
+#
+# Every memoized GrammarSampler method has its own Cache, and all of a
+# sampler's caches draw on one CachePool. When the pool goes over its budget,
+# entries are evicted by GreedyDual-Size: an entry's priority is the pool's
+# clock plus its cost (the seconds it took to compute) per byte, refreshed on
+# every hit, and the lowest-priority entry goes first, advancing the clock to
+# its priority. So cheap entries and large ones go before expensive small
+# ones, and entries that aren't used age out as the clock moves past them.
+#
+# Unlike functools.lru_cache on a method, the caches belong to the sampler
+# and don't hold a reference to it, so they go away with it.
+
+import functools
+import heapq
+import sys
+import time
+import numpy as np
+
+MISSING = object()
+
+# Rough per-entry overhead: the dict slot, the entry list and the key.
+ENTRY_BYTES = 160
+
+# Entry layout (a list, for cheap updates on hits).
+VALUE, SIZE, CREDIT, PRIORITY, CACHE, KEY = range(6)
+
+
+# Approximate memory held by a cached value. Arrays count their buffers;
+# tuples and dicts count their items too, and lists are taken to hold small
+# ints (as the token id lists in DFA token tables do). Other values (including
+# frozensets of stacks, whose nodes are shared with other states) count only
+# their own object.
+def value_size(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, list):
+        return sys.getsizeof(value) + 32 * len(value)
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(value_size(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            value_size(k) + value_size(v) for k, v in value.items()
+        )
+    return sys.getsizeof(value)
+
+
+# The caches of one sampler by name, created on first use.
+class CachePool(dict):
+    # `budget` in bytes, or None for no limit.
+    def __init__(self, budget=None):
+        super().__init__()
+        self.budget = budget
+        self.usage = 0
+        self.clock = 0.0
+        self.heap = []
+        self.counter = 0
+
+    def __missing__(self, name):
+        cache = self[name] = Cache(self)
+        return cache
+
+    def add(self, entry):
+        self.usage += entry[SIZE]
+        self.counter += 1
+        heapq.heappush(self.heap, (entry[PRIORITY], self.counter, entry))
+        if self.budget is not None and self.usage > self.budget:
+            self.evict()
+
+    def evict(self):
+        heap = self.heap
+        while self.usage > self.budget and heap:
+            priority, _, entry = heapq.heappop(heap)
+            cache = entry[CACHE]
+            if cache.entries.get(entry[KEY]) is not entry:
+                continue  # already replaced or dropped
+            if entry[PRIORITY] > priority:
+                # hit since it was pushed: requeue at its current priority
+                self.counter += 1
+                heapq.heappush(heap, (entry[PRIORITY], self.counter, entry))
+                continue
+            del cache.entries[entry[KEY]]
+            cache.bytes -= entry[SIZE]
+            cache.evictions += 1
+            self.usage -= entry[SIZE]
+            self.clock = priority
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in self.items()}
+
+
+class Cache:
+    def __init__(self, pool):
+        self.pool = pool
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        entry[PRIORITY] = self.pool.clock + entry[CREDIT]
+        return entry[VALUE]
+
+    # The cached value for `key`, or None, without counting a hit or miss or
+    # refreshing the entry.
+    def peek(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry[VALUE]
+
+    def items(self):
+        return [(key, entry[VALUE]) for key, entry in self.entries.items()]
+
+    # `cost` is the seconds the value took to compute.
+    def put(self, key, value, cost, size=None):
+        if size is None:
+            size = value_size(value)
+        size += ENTRY_BYTES
+        credit = cost / size
+        entry = [value, size, credit, self.pool.clock + credit, self, key]
+        old = self.entries.get(key)
+        if old is not None:
+            self.bytes -= old[SIZE]
+            self.pool.usage -= old[SIZE]
+        self.entries[key] = entry
+        self.bytes += size
+        self.pool.add(entry)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+# Memoize a method in the `self.caches` pool, under the method's name. Results
+# are keyed by the positional argument, or the tuple of them if there are
+# several. Hits are on the hot path of trie traversal, so they are inlined.
+def cached(method):
+    name = method.__name__
+
+    def miss(self, cache, key, args):
+        cache.misses += 1
+        st = time.perf_counter()
+        value = method(self, *args)
+        cache.put(key, value, time.perf_counter() - st)
+        return value
+
+    if method.__code__.co_argcount == 2:
+
+        @functools.wraps(method)
+        def wrapper(self, key):
+            cache = self.caches[name]
+            entry = cache.entries.get(key)
+            if entry is None:
+                return miss(self, cache, key, (key,))
+            cache.hits += 1
+            entry[PRIORITY] = cache.pool.clock + entry[CREDIT]
+            return entry[VALUE]
+
+    else:
+
+        @functools.wraps(method)
+        def wrapper(self, *key):
+            cache = self.caches[name]
+            entry = cache.entries.get(key)
+            if entry is None:
+                return miss(self, cache, key, key)
+            cache.hits += 1
+            entry[PRIORITY] = cache.pool.clock + entry[CREDIT]
+            return entry[VALUE]
+
+    return wrapper
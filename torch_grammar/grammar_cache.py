@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from .masks import WORD
+from .token_trie import TokenTrie, decode_tokens, encode_tokens
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; appends are unlocked there
+    fcntl = None
+
+# Bump whenever the binary grammar, trie or mask layout changes. Caches written
+# by other versions are never read, since the version is part of the key.
+FORMAT_VERSION = 6
+
+
+# Where GrammarSampler.publish puts grammars for other processes to attach to:
+# a tmpfs, so that the files are shared memory rather than disk.
+def default_shared_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/torch-grammar"
+    return os.path.join(tempfile.gettempdir(), "torch-grammar")
+
+
+def cache_key(input_text, start_rule_name, tokenizer, optimize=True):
+    h = hashlib.sha256()
+    h.update(f"torch-grammar:{FORMAT_VERSION}\0".encode())
+    h.update(input_text.encode("utf-8") + b"\0")
+    h.update(start_rule_name.encode("utf-8") + b"\0")
+    h.update(f"optimize={bool(optimize)}\0".encode())
+    if isinstance(tokenizer, TokenTrie):
+        h.update(b"TokenTrie:" + tokenizer.fingerprint().encode() + b"\0")
+        return h.hexdigest()
+    # token formatting depends on the tokenizer class, not just its vocab
+    h.update(tokenizer.__class__.__name__.encode() + b"\0")
+    h.update(str(tokenizer.eos_token_id).encode() + b"\0")
+    for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda x: x[1]):
+        h.update(f"{token_id}:{token}\0".encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+
+# A digest of a compiled grammar and the vocab it was compiled for, recorded in
+# meta.json so that a directory can be checked against the grammar it should
+# hold (published directories are named by the caller, not by content).
+def grammar_key(src, start_rule_id, token_trie):
+    h = hashlib.sha256()
+    h.update(f"torch-grammar:{FORMAT_VERSION}\0".encode())
+    h.update(np.asarray(src, dtype="<i4").tobytes())
+    h.update(f"\0{start_rule_id}\0".encode())
+    h.update(token_trie.fingerprint().encode())
+    return h.hexdigest()
+
+
+# A directory of arrays: meta.json and one .npy file per array, written once
+# and memory-mapped on load.
+def read_arrays(path):
+    with open(os.path.join(path, "meta.json"), "r") as file:
+        meta = json.load(file)
+    if meta["version"] != FORMAT_VERSION:
+        raise RuntimeError(f"grammar cache version mismatch at {path}")
+    arrays = {
+        name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        for name in meta["arrays"]
+    }
+    return meta, arrays
+
+
+# Write to a temporary directory and rename it into place, so concurrent
+# writers race harmlessly and readers never see a partial directory. With
+# `replace`, an existing directory is moved aside first; processes that mapped
+# it keep their mappings.
+def write_arrays(cache_dir, path, meta, arrays, replace=False):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(array))
+        meta = dict(meta, version=FORMAT_VERSION, arrays=sorted(arrays))
+        with open(os.path.join(tmp, "meta.json"), "w") as file:
+            json.dump(meta, file)
+        if replace and os.path.exists(path):
+            old = tempfile.mkdtemp(dir=cache_dir, prefix=".old-")
+            os.rename(path, os.path.join(old, "old"))
+            shutil.rmtree(old, ignore_errors=True)
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# A directory holding one compiled grammar:
+#
+# - meta.json and .npy files for the binary grammar and rule offsets;
+# - masks.bin, fixed-size (stack digest, packed mask) records that every
+#   process using the grammar can read and extend (see MaskFile).
+#
+# The token trie and token table are stored once per vocab, next to the
+# grammars, in a `vocab-<fingerprint>` directory that every grammar compiled
+# for that vocab refers to.
+class GrammarCache:
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, key)
+        self.masks = None
+
+    @classmethod
+    def for_grammar(
+        cls, cache_dir, input_text, start_rule_name, tokenizer, optimize=True
+    ):
+        key = cache_key(input_text, start_rule_name, tokenizer, optimize)
+        return cls(cache_dir, key)
+
+    def has_grammar(self):
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    # The grammar key recorded in meta.json, or None (also for directories
+    # written before keys were recorded).
+    def grammar_key(self):
+        try:
+            with open(os.path.join(self.path, "meta.json"), "r") as file:
+                return json.load(file).get("key")
+        except FileNotFoundError:
+            return None
+
+    def load_grammar(self):
+        return read_arrays(self.path)
+
+    # With `replace`, an existing grammar directory (masks and all) is
+    # replaced rather than kept.
+    def save_grammar(self, meta, arrays, replace=False):
+        write_arrays(self.cache_dir, self.path, meta, arrays, replace)
+
+    def vocab_path(self, fingerprint):
+        return os.path.join(self.cache_dir, "vocab-" + fingerprint)
+
+    # The token trie for a vocab fingerprint, memory-mapped read-only.
+    def load_vocab(self, fingerprint):
+        meta, arrays = read_arrays(self.vocab_path(fingerprint))
+        tokens = decode_tokens(arrays["token_lengths"], arrays["token_data"])
+        trie = TokenTrie.from_arrays(meta["eos_token_id"], tokens, arrays)
+        trie._fingerprint = fingerprint
+        return trie
+
+    def save_vocab(self, token_trie):
+        path = self.vocab_path(token_trie.fingerprint())
+        if os.path.exists(os.path.join(path, "meta.json")):
+            return
+        token_lengths, token_data = encode_tokens(token_trie.tokens)
+        arrays = dict(
+            token_trie.arrays(), token_lengths=token_lengths, token_data=token_data
+        )
+        meta = {"eos_token_id": token_trie.eos_token_id}
+        write_arrays(self.cache_dir, path, meta, arrays)
+
+    def open_masks(self, num_words):
+        self.masks = MaskFile(os.path.join(self.path, "masks.bin"), num_words)
+        return self.masks
+
+
+# The number of records written, then room for at least that many records.
+# Writers double the room when it runs out, under a file lock, and write each
+# record before counting it, so readers map the file O(log n) times as it
+# grows and never see a partial record.
+COUNT = np.dtype("<u8")
+MIN_RECORDS = 64
+
+
+class MaskFile:
+    def __init__(self, path, num_words):
+        self.path = path
+        self.record = np.dtype([("key", "V16"), ("mask", WORD, (num_words,))])
+        self.index = {}
+        self.count = 0
+        self.header = None
+        self.rows = None
+        self.refresh()
+
+    # Index any records added (by this or another process) since the last
+    # refresh, remapping the file only if they don't fit in the mapping.
+    def refresh(self):
+        if self.header is None and not self.remap():
+            return
+        count = int(self.header[0])
+        if count <= self.count:
+            return
+        if count > len(self.rows):
+            self.remap()
+        keys = self.rows["key"][self.count : count].tolist()
+        for row, key in enumerate(keys, self.count):
+            self.index.setdefault(key, row)
+        self.count = count
+
+    # Map the whole file, in place of the previous mapping. That one is
+    # unmapped once the masks that get() returned from it are dropped too.
+    def remap(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return False
+        capacity = (size - COUNT.itemsize) // self.record.itemsize
+        if capacity <= 0:
+            return False
+        self.header = self.rows = None
+        data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        self.header = data[: COUNT.itemsize].view(COUNT)
+        records = data[
+            COUNT.itemsize : COUNT.itemsize + capacity * self.record.itemsize
+        ]
+        self.rows = records.view(self.record)
+        return True
+
+    def __len__(self):
+        return len(self.index)
+
+    # The packed mask for a stack digest, as a read-only view into the mapped
+    # file, or None.
+    def get(self, key):
+        row = self.index.get(key)
+        if row is None:
+            self.refresh()
+            row = self.index.get(key)
+            if row is None:
+                return None
+        return self.rows["mask"][row]
+
+    def add(self, key, words):
+        record = np.zeros(1, dtype=self.record)
+        record["key"] = key
+        record["mask"] = words
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        with os.fdopen(fd, "r+b") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            header = file.read(COUNT.itemsize)
+            count = 0
+            if len(header) == COUNT.itemsize:
+                count = int(np.frombuffer(header, dtype=COUNT)[0])
+            size = os.fstat(fd).st_size
+            capacity = (size - COUNT.itemsize) // self.record.itemsize
+            if count >= capacity:
+                capacity = max(MIN_RECORDS, 2 * capacity)
+                file.truncate(COUNT.itemsize + capacity * self.record.itemsize)
+            file.seek(COUNT.itemsize + count * self.record.itemsize)
+            file.write(record.tobytes())
+            file.flush()
+            file.seek(0)
+            file.write(np.array([count + 1], dtype=COUNT).tobytes())
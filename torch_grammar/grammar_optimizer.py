@@ -0,0 +1,313 @@
+# Optimization passes over the binary grammar produced by grammar_parser.
+#
+# Every grammar position (rule reference or character class) is a possible
+# stack top, so it can appear in a parser state, a cached mask key and an
+# advance_stack call. These passes shrink the grammar without changing the
+# language it accepts:
+#
+# - unreachable: drop rules that can't be reached from the start rule;
+# - merge_chars: sort and merge overlapping or adjacent ranges in a character
+#   class, and merge alternatives that are a single character class (such as
+#   `"a" | "b" | [0-9]`) into one;
+# - dedup: drop repeated alternatives, and point references to structurally
+#   identical rules (such as the ones generated for two `[0-9]*`) at one copy;
+# - inline: splice rules that are referenced once into their only user,
+#   unless that would split a regular rule (see regular.py) into a rule that
+#   isn't, or into the start rule, which is never compiled: its DFA would
+#   become several smaller ones, stepped by the PDA;
+# - left_factor: rewrite `A x | A y | A z` as `A R` with `R ::= x | y | z`.
+#
+# The passes run until none of them changes anything. Rules are decoded into
+# {rule_id: [alternative, ...]}, where an alternative is a tuple of elements: a
+# rule id (a reference) or a tuple of (lo, hi) ranges (a character class).
+
+from .grammar_parser import ParseState
+from .regular import regular_rule_ids
+
+
+def decode(src):
+    rules = {}
+    pos = 0
+    while src[pos] != 0xFFFF:
+        rule_id = src[pos]
+        pos += 1
+        alternatives = []
+        while src[pos]:
+            end = pos + src[pos]
+            pos += 1
+            elements = []
+            while pos < end:
+                if src[pos] == 1:
+                    elements.append(src[pos + 1])
+                    pos += 2
+                else:
+                    values = src[pos + 1 : pos + 1 + src[pos]]
+                    elements.append(tuple(zip(values[::2], values[1::2])))
+                    pos += 1 + src[pos]
+            alternatives.append(tuple(elements))
+            pos += 1
+        rules[rule_id] = alternatives
+        pos += 1
+    return rules
+
+
+def encode(rules):
+    src = []
+    for rule_id in sorted(rules):
+        src.append(rule_id)
+        for alternative in rules[rule_id]:
+            start = len(src)
+            src.append(0)
+            for element in alternative:
+                if isinstance(element, int):
+                    src.extend((1, element))
+                else:
+                    src.append(2 * len(element))
+                    for lo, hi in element:
+                        src.extend((lo, hi))
+            src[start] = len(src) - start
+            src.append(0)
+        src.append(0)
+    src.append(0xFFFF)
+    return src
+
+
+def count_positions(rules):
+    return sum(len(alt) for alternatives in rules.values() for alt in alternatives)
+
+
+# The ids of the rules that regular.py can compile to DFAs.
+def regular_rules(rules):
+    src = encode(rules)
+    positions = [None] * (max(rules, default=-1) + 1)
+    pos = 0
+    while src[pos] != 0xFFFF:
+        positions[src[pos]] = pos
+        pos += 1
+        while src[pos]:
+            pos += 1 + src[pos]
+        pos += 1
+    return regular_rule_ids(src, positions)
+
+
+def references(alternatives):
+    for alternative in alternatives:
+        for element in alternative:
+            if isinstance(element, int):
+                yield element
+
+
+def unique(alternatives):
+    return list(dict.fromkeys(alternatives))
+
+
+def unreachable(rules, start_rule_id, new_rule_id):
+    reachable = {start_rule_id}
+    todo = [start_rule_id]
+    while todo:
+        for ref in references(rules.get(todo.pop(), ())):
+            if ref not in reachable:
+                reachable.add(ref)
+                todo.append(ref)
+    for rule_id in list(rules):
+        if rule_id not in reachable:
+            del rules[rule_id]
+
+
+def merge_ranges(ranges):
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+
+def merge_chars(rules, start_rule_id, new_rule_id):
+    for rule_id, alternatives in rules.items():
+        result = []
+        chars = None
+        for alternative in alternatives:
+            alternative = tuple(
+                e if isinstance(e, int) else merge_ranges(e) for e in alternative
+            )
+            if len(alternative) == 1 and not isinstance(alternative[0], int):
+                if chars is None:
+                    chars = len(result)
+                    result.append(alternative)
+                else:
+                    ranges = result[chars][0] + alternative[0]
+                    result[chars] = (merge_ranges(ranges),)
+                continue
+            result.append(alternative)
+        rules[rule_id] = result
+
+
+def dedup(rules, start_rule_id, new_rule_id):
+    # References to the rule itself are replaced with None, so that copies of
+    # the same recursive rule (like those generated for `x*`) compare equal.
+    while True:
+        canonical = {}
+        replace = {}
+        for rule_id in sorted(rules, key=lambda r: (r != start_rule_id, r)):
+            alternatives = unique(rules[rule_id])
+            rules[rule_id] = alternatives
+            key = tuple(
+                tuple(None if e == rule_id else e for e in alternative)
+                for alternative in alternatives
+            )
+            if key in canonical:
+                replace[rule_id] = canonical[key]
+            else:
+                canonical[key] = rule_id
+        if not replace:
+            return
+        for rule_id in replace:
+            del rules[rule_id]
+        for rule_id, alternatives in rules.items():
+            rules[rule_id] = [
+                tuple(replace.get(e, e) if isinstance(e, int) else e for e in alt)
+                for alt in alternatives
+            ]
+
+
+def inline(rules, start_rule_id, new_rule_id):
+    # A rule that is a single element can take its place everywhere.
+    aliases = {
+        rule_id: alternatives[0][0]
+        for rule_id, alternatives in rules.items()
+        if rule_id != start_rule_id and len(alternatives) == 1
+        if len(alternatives[0]) == 1
+    }
+    replace = {}
+    for rule_id in aliases:
+        element = rule_id
+        while isinstance(element, int) and element in aliases:
+            element = aliases[element]
+            if element == rule_id:
+                break
+        if element not in aliases:
+            replace[rule_id] = element
+    if replace:
+        for rule_id in replace:
+            del rules[rule_id]
+        for rule_id, alternatives in rules.items():
+            rules[rule_id] = [
+                tuple(replace.get(e, e) if isinstance(e, int) else e for e in alt)
+                for alt in alternatives
+            ]
+
+    counts = {}
+    users = {}
+    for rule_id, alternatives in rules.items():
+        for ref in references(alternatives):
+            counts[ref] = counts.get(ref, 0) + 1
+            users[ref] = rule_id
+
+    regular = regular_rules(rules) - {start_rule_id}
+    for rule_id in sorted(rules):
+        user = users.get(rule_id)
+        if counts.get(rule_id) != 1 or rule_id == start_rule_id or user == rule_id:
+            continue
+        if rule_id in regular and user not in regular:
+            continue
+        body = rules[rule_id]
+        result = []
+        for alternative in rules[user]:
+            if rule_id not in alternative:
+                result.append(alternative)
+            elif len(body) == 1:
+                i = alternative.index(rule_id)
+                result.append(alternative[:i] + body[0] + alternative[i + 1 :])
+            elif alternative == (rule_id,):
+                result.extend(body)
+            else:
+                break
+        else:
+            rules[user] = result
+            del rules[rule_id]
+            for ref in references(body):
+                if counts[ref] == 1:
+                    users[ref] = user
+
+
+def common_prefix(alternatives):
+    prefix = alternatives[0]
+    for alternative in alternatives[1:]:
+        n = 0
+        while n < min(len(prefix), len(alternative)) and prefix[n] == alternative[n]:
+            n += 1
+        prefix = prefix[:n]
+    return prefix
+
+
+def left_factor(rules, start_rule_id, new_rule_id):
+    todo = sorted(rules)
+    while todo:
+        rule_id = todo.pop()
+        groups = {}
+        for alternative in rules[rule_id]:
+            if alternative:
+                groups.setdefault(alternative[0], []).append(alternative)
+        result = []
+        for alternative in rules[rule_id]:
+            group = groups.get(alternative[0]) if alternative else None
+            if group is None or len(group) < 2:
+                result.append(alternative)
+                continue
+            if alternative is not group[0]:
+                continue
+            prefix = common_prefix(group)
+            # Factoring out k elements shared by g alternatives replaces g * k
+            # positions with k + 1 (the prefix and a reference).
+            if len(group) * len(prefix) <= len(prefix) + 1:
+                result.extend(group)
+                continue
+            suffix_rule_id = new_rule_id(rule_id)
+            rules[suffix_rule_id] = unique(alt[len(prefix) :] for alt in group)
+            todo.append(suffix_rule_id)
+            result.append(prefix + (suffix_rule_id,))
+        rules[rule_id] = result
+
+
+PASSES = (unreachable, merge_chars, dedup, inline, left_factor)
+
+
+# Optimize a parsed grammar. Returns a new ParseState (whose symbol_ids only
+# name the rules that are left) and a report of what each pass removed, in
+# rules and in grammar positions.
+def optimize(state, start_rule_id, passes=PASSES):
+    rules = decode(state.out_grammar)
+    names = {rule_id: name for name, rule_id in state.symbol_ids.items()}
+    next_id = max(names, default=-1) + 1
+
+    def new_rule_id(base_rule_id):
+        nonlocal next_id
+        rule_id = next_id
+        next_id += 1
+        names[rule_id] = f"{names[base_rule_id]}_{rule_id}"
+        return rule_id
+
+    report = {
+        "before": {"rules": len(rules), "positions": count_positions(rules)},
+        "passes": {p.__name__: {"rules": 0, "positions": 0} for p in passes},
+    }
+    changed = start_rule_id in rules
+    while changed:
+        changed = False
+        for optimization in passes:
+            num_rules = len(rules)
+            num_positions = count_positions(rules)
+            optimization(rules, start_rule_id, new_rule_id)
+            removed = report["passes"][optimization.__name__]
+            removed["rules"] += num_rules - len(rules)
+            removed["positions"] += num_positions - count_positions(rules)
+            if len(rules) != num_rules or count_positions(rules) != num_positions:
+                changed = True
+    report["after"] = {"rules": len(rules), "positions": count_positions(rules)}
+
+    optimized = ParseState()
+    optimized.symbol_ids = {names[rule_id]: rule_id for rule_id in sorted(rules)}
+    optimized.out_grammar = encode(rules)
+    return optimized, report
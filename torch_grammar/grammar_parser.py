@@ -1,3 +1,4 @@
+import re
 import sys
 
 
@@ -19,6 +20,29 @@ def generate_symbol_id(state, base_name):
     return next_id
 
 
+# Raised for malformed grammars, with the position of the problem.
+class GrammarSyntaxError(RuntimeError):
+    def __init__(self, message, src, pos):
+        self.message = message
+        self.pos = pos
+        self.line = src.count("\n", 0, pos) + 1
+        self.column = pos - (src.rfind("\n", 0, pos) + 1) + 1
+        context = src[pos : pos + 20].split("\n")[0]
+        super().__init__(
+            f"{message} at line {self.line}, column {self.column}: {context!r}"
+        )
+
+
+# All parse_* functions take the full source and an index into it, and return
+# the index just past whatever they consumed, so parsing is a single pass with
+# no copying of the remaining input.
+
+SPACE = re.compile(r"(?:[^\S\r\n]|#[^\r\n]*)*")
+SPACE_OR_NEWLINE = re.compile(r"(?:\s|#[^\r\n]*)*")
+NAME = re.compile(r"[\w-]+")
+LITERAL_RUN = re.compile(r'[^"\\]+')
+
+
 def is_word_char(c):
     return c.isalnum() or c == "-" or c == "_"
 
@@ -31,112 +55,119 @@ def hex_to_int(c):
     return -1
 
 
-def parse_space(src, newline_ok):
-    pos = 0
-    while pos < len(src) and (src[pos].isspace() or src[pos] == "#"):
-        if src[pos] == "#":
-            while pos < len(src) and src[pos] not in ("\r", "\n"):
-                pos += 1
-        else:
-            if not newline_ok and src[pos] in ("\r", "\n"):
-                break
-            pos += 1
-    return src[pos:]
+def parse_space(src, pos, newline_ok):
+    return (SPACE_OR_NEWLINE if newline_ok else SPACE).match(src, pos).end()
 
 
-def parse_name(src):
-    pos = 0
-    while pos < len(src) and is_word_char(src[pos]):
-        pos += 1
-    if pos == 0:
-        raise RuntimeError("expecting name at " + src)
-    return src[:pos], src[pos:]
+def parse_name(src, pos):
+    match = NAME.match(src, pos)
+    if not match:
+        raise GrammarSyntaxError("expecting name", src, pos)
+    return match.group(), match.end()
 
 
-def parse_char(src):
-    if src[0] == "\\":
-        esc = src[1]
+# Returns the code point of the (possibly escaped) character at `pos`.
+def parse_char(src, pos):
+    if pos >= len(src):
+        raise GrammarSyntaxError("unexpected end of input", src, pos)
+    if src[pos] == "\\":
+        esc = src[pos + 1 : pos + 2]
         if esc == "x":
-            first = hex_to_int(src[2])
-            if first > -1:
-                second = hex_to_int(src[3])
-                if second > -1:
-                    return (first << 4) + second, src[4:]
-            raise RuntimeError("expecting \\xNN at " + src)
+            first = hex_to_int(src[pos + 2 : pos + 3] or "?")
+            second = hex_to_int(src[pos + 3 : pos + 4] or "?")
+            if first > -1 and second > -1:
+                return (first << 4) + second, pos + 4
+            raise GrammarSyntaxError("expecting \\xNN", src, pos)
         elif esc in ('"', "[", "]"):
-            return esc, src[2:]
+            return ord(esc), pos + 2
         elif esc == "r":
-            return "\r", src[2:]
+            return ord("\r"), pos + 2
         elif esc == "n":
-            return "\n", src[2:]
+            return ord("\n"), pos + 2
         elif esc == "t":
-            return "\t", src[2:]
-        raise RuntimeError("unknown escape at " + src)
-    elif src:
-        return src[0], src[1:]
-    raise RuntimeError("unexpected end of input")
+            return ord("\t"), pos + 2
+        raise GrammarSyntaxError("unknown escape", src, pos)
+    return ord(src[pos]), pos + 1
+
+
+def expect_more(src, pos, what):
+    if pos >= len(src):
+        raise GrammarSyntaxError(f"unexpected end of input, expecting {what}", src, pos)
 
 
-def parse_sequence(state, src, rule_name, outbuf, is_nested):
+def parse_sequence(state, src, pos, rule_name, outbuf, is_nested):
     out_start = len(outbuf)
 
     # sequence size, will be replaced at end when known
     outbuf.append(0)
 
     last_sym_start = len(outbuf)
-    pos = src
-    while pos:
-        if pos[0] == '"':  # literal string
-            pos = pos[1:]
+    end = len(src)
+    while pos < end:
+        c = src[pos]
+        if c == '"':  # literal string
+            pos += 1
             last_sym_start = len(outbuf)
-            while pos[0] != '"':
-                char_pair, pos = parse_char(pos)
-
-                # each char of a literal is encoded as a "range" of char - char
-                outbuf.append(2)
-                outbuf.append(ord(char_pair))
-                outbuf.append(ord(char_pair))
-            pos = parse_space(pos[1:], is_nested)
-        elif pos[0] == "[":  # char range(s)
-            pos = pos[1:]
+            while True:
+                expect_more(src, pos, "'\"'")
+                if src[pos] == '"':
+                    break
+                run = LITERAL_RUN.match(src, pos)
+                if run:
+                    # each char of a literal is encoded as a "range" of char - char
+                    for char in run.group():
+                        outbuf.extend((2, ord(char), ord(char)))
+                    pos = run.end()
+                else:
+                    char, pos = parse_char(src, pos)
+                    outbuf.extend((2, char, char))
+            pos = parse_space(src, pos + 1, is_nested)
+        elif c == "[":  # char range(s)
+            pos += 1
             last_sym_start = len(outbuf)
             # num chars in range - replaced at end of loop
             outbuf.append(0)
-            while pos[0] != "]":
-                char_pair, pos = parse_char(pos)
-
-                outbuf.append(ord(char_pair))
-                if pos[0] == "-" and pos[1] != "]":
-                    endchar_pair, pos = parse_char(pos[1:])
-                    outbuf.append(ord(endchar_pair))
+            while True:
+                expect_more(src, pos, "']'")
+                if src[pos] == "]":
+                    break
+                char, pos = parse_char(src, pos)
+
+                outbuf.append(char)
+                if src[pos : pos + 1] == "-" and src[pos + 1 : pos + 2] not in (
+                    "]",
+                    "",
+                ):
+                    endchar, pos = parse_char(src, pos + 1)
+                    outbuf.append(endchar)
                 else:
                     # chars that aren't part of a c1-c2 range are just doubled (i.e., c-c)
-                    outbuf.append(ord(char_pair))
+                    outbuf.append(char)
             # replace num chars with actual
             outbuf[last_sym_start] = len(outbuf) - last_sym_start - 1
-            pos = parse_space(pos[1:], is_nested)
-        elif is_word_char(pos[0]):  # rule reference
-            name, pos = parse_name(pos)
+            pos = parse_space(src, pos + 1, is_nested)
+        elif is_word_char(c):  # rule reference
+            name, pos = parse_name(src, pos)
             ref_rule_id = get_symbol_id(state, name)
-            pos = parse_space(pos, is_nested)
+            pos = parse_space(src, pos, is_nested)
             last_sym_start = len(outbuf)
             outbuf.append(1)
             outbuf.append(ref_rule_id)
-        elif pos[0] == "(":  # grouping
+        elif c == "(":  # grouping
             # parse nested alternates into synthesized rule
-            pos = parse_space(pos[1:], True)
+            pos = parse_space(src, pos + 1, True)
             sub_rule_id = generate_symbol_id(state, rule_name)
-            pos = parse_alternates(state, pos, rule_name, sub_rule_id, True)
+            pos = parse_alternates(state, src, pos, rule_name, sub_rule_id, True)
             last_sym_start = len(outbuf)
             # output reference to synthesized rule
             outbuf.append(1)
             outbuf.append(sub_rule_id)
-            if pos[0] != ")":
-                raise RuntimeError("expecting ')' at " + pos)
-            pos = parse_space(pos[1:], is_nested)
-        elif pos[0] in ("*", "+", "?"):  # repetition operator
+            if src[pos : pos + 1] != ")":
+                raise GrammarSyntaxError("expecting ')'", src, pos)
+            pos = parse_space(src, pos + 1, is_nested)
+        elif c in ("*", "+", "?"):  # repetition operator
             if len(outbuf) - out_start - 1 == 0:
-                raise RuntimeError("expecting preceeding item to */+/? at " + pos)
+                raise GrammarSyntaxError("expecting preceding item to */+/?", src, pos)
             out_grammar = state.out_grammar
 
             # apply transformation to previous symbol (last_sym_start -
@@ -151,7 +182,7 @@ def parse_sequence(state, src, rule_name, outbuf, is_nested):
             out_grammar.append(0)
             # add preceding symbol to generated rule
             out_grammar.extend(outbuf[last_sym_start:])
-            if pos[0] in ("*", "+"):
+            if c in ("*", "+"):
                 # cause generated rule to recurse
                 out_grammar.append(1)
                 out_grammar.append(sub_rule_id)
@@ -162,7 +193,7 @@ def parse_sequence(state, src, rule_name, outbuf, is_nested):
             sub_rule_start = len(out_grammar)
             # placeholder for size of 2nd alternate
             out_grammar.append(0)
-            if pos[0] == "+":
+            if c == "+":
                 # add preceding symbol as alternate only for '+'
                 out_grammar.extend(outbuf[last_sym_start:])
             # apply actual size of 2nd alternate
@@ -174,7 +205,7 @@ def parse_sequence(state, src, rule_name, outbuf, is_nested):
             # in original rule, replace previous symbol with reference to generated rule
             outbuf[last_sym_start:] = [1, sub_rule_id]
 
-            pos = parse_space(pos[1:], is_nested)
+            pos = parse_space(src, pos + 1, is_nested)
         else:
             break
     # apply actual size of this alternate sequence
@@ -184,49 +215,47 @@ def parse_sequence(state, src, rule_name, outbuf, is_nested):
     return pos
 
 
-def parse_alternates(state, src, rule_name, rule_id, is_nested):
+def parse_alternates(state, src, pos, rule_name, rule_id, is_nested):
     outbuf = []
-    pos = parse_sequence(state, src, rule_name, outbuf, is_nested)
-    while pos[0] == "|":
-        pos = parse_space(pos[1:], True)
-        pos = parse_sequence(state, pos, rule_name, outbuf, is_nested)
+    pos = parse_sequence(state, src, pos, rule_name, outbuf, is_nested)
+    while src[pos : pos + 1] == "|":
+        pos = parse_space(src, pos + 1, True)
+        pos = parse_sequence(state, src, pos, rule_name, outbuf, is_nested)
     state.out_grammar.append(rule_id)
     state.out_grammar.extend(outbuf)
     state.out_grammar.append(0)
     return pos
 
 
-def parse_rule(state, src):
-    name, pos = parse_name(src)
-    pos = parse_space(pos, False)
+def parse_rule(state, src, pos):
+    name, pos = parse_name(src, pos)
+    pos = parse_space(src, pos, False)
     rule_id = get_symbol_id(state, name)
 
-    if pos[:3] != "::=":
-        raise RuntimeError("expecting ::= at " + pos)
-    pos = parse_space(pos[3:], True)
+    if not src.startswith("::=", pos):
+        raise GrammarSyntaxError("expecting ::=", src, pos)
+    pos = parse_space(src, pos + 3, True)
 
-    pos = parse_alternates(state, pos, name, rule_id, False)
+    pos = parse_alternates(state, src, pos, name, rule_id, False)
 
-    if pos[0] == "\r":
-        pos = pos[2:] if pos[1] == "\n" else pos[1:]
-    elif pos[0] == "\n":
-        pos = pos[1:]
-    elif pos:
-        raise RuntimeError("expecting newline or end at " + pos)
-    return parse_space(pos, True)
+    if src.startswith("\r\n", pos):
+        pos += 2
+    elif src[pos : pos + 1] in ("\r", "\n"):
+        pos += 1
+    elif pos < len(src):
+        raise GrammarSyntaxError("expecting newline or end", src, pos)
+    return parse_space(src, pos, True)
 
 
+# Parse a grammar into its binary form. Raises GrammarSyntaxError (with the
+# line and column of the problem) if the grammar is malformed.
 def parse(src):
-    try:
-        state = ParseState()
-        pos = parse_space(src, True)
-        while pos:
-            pos = parse_rule(state, pos)
-        state.out_grammar.append(0xFFFF)
-        return state
-    except RuntimeError as err:
-        print("error parsing grammar:", err)
-        return ParseState()
+    state = ParseState()
+    pos = parse_space(src, 0, True)
+    while pos < len(src):
+        pos = parse_rule(state, src, pos)
+    state.out_grammar.append(0xFFFF)
+    return state
 
 
 def print_rule(file, base, index, symbol_id_names):
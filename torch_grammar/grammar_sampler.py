@@ -1,49 +1,426 @@
-from math import inf
 from . import grammar_parser
-from .token_trie import TokenTrie, LEAF
-from functools import lru_cache
+from .grammar_optimizer import optimize as optimize_grammar
+from .token_trie import TokenTrie, NO_TOKEN
+from .graph_stack import EMPTY, merge, linearize, digest, depth
+from .regular import REJECT, RegularRules, run_dfa
+from .grammar_cache import GrammarCache, default_shared_dir, grammar_key
+from .async_masks import HostBuffers, MaskFuture
+from .caches import ENTRY_BYTES, CachePool, cached, value_size
+from .masks import WORD, ALL, MaskTable, num_words, pack, unpack
+from .masks import to_tensor, unpack_tensor
+from .masks import apply as apply_mask
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+import os
+import threading
 import time
+import numpy as np
 import torch
 
 
+# Forced runs longer than this are cut short (and resume on the next call).
+MAX_FORCED_BYTES = 1024
+
+# Default memory budgets for a sampler's caches (see caches.py) and for its
+# masks on each device (see masks.MaskTable), in bytes.
+HOST_CACHE_BYTES = 1 << 30
+DEVICE_CACHE_BYTES = 1 << 28
+
+# Set in precompile worker processes.
+_worker_sampler = None
+
+
+def _init_worker(sampler):
+    global _worker_sampler
+    _worker_sampler = sampler
+
+
+# A stack's mask and the seconds it took to compute.
+def _timed_acceptance(sampler, stack):
+    st = time.perf_counter()
+    words = sampler.compute_token_acceptance(stack)
+    return words, time.perf_counter() - st
+
+
+def _worker_acceptance(stack):
+    return _timed_acceptance(_worker_sampler, stack)
+
+
 class LogitsProcessor:
-    def __init__(self, grammar):
+    # With `top_k`, masking is lazy: see GrammarSampler.filter_logits_top_k.
+    #
+    # With an `executor` (e.g. a ThreadPoolExecutor), advance() starts
+    # computing the next step's masks in the background so that the work
+    # overlaps with the model's forward pass; the next call waits for them.
+    # The background job shares the grammar's caches, which aren't
+    # thread-safe, so everything here that touches the grammar first waits
+    # for it (see using_grammar).
+    #
+    # Each row keeps the history of its states and the tokens that led to
+    # them, so `input_ids` may change arbitrarily after the prompt between
+    # calls, as in speculative decoding: the row rolls back to the longest
+    # prefix it shares with its history, and accepts the rest in order. A
+    # history is a persistent linked list of `(state, length, previous,
+    # token)` nodes ending in None, and states are interned ids (see
+    # GrammarSampler.intern_state), so copying a row shares everything: fork,
+    # snapshot, restore and reorder cost O(1) per row.
+    #
+    # To find that prefix without walking the whole history, each row also
+    # keeps `(ids, offset, count)` from the last call: the row's input ids,
+    # where its history starts in them, and how many history tokens are known
+    # to match them (later ones were accepted since, or replaced).
+    def __init__(self, grammar, batch_size=1, top_k=None, executor=None):
         self.grammar = grammar
-        self.stacks = grammar.init_stacks()
-        self.last_size = None
+        self.top_k = top_k
+        self.executor = executor
+        self.pending = None
+        self.buffers = HostBuffers() if executor is not None else None
+        self.states = []
+        self.histories = []
+        self.inputs = []
+        self.add_rows(batch_size)
+
+    # Rows can join a batch at any time (e.g. under continuous batching); they
+    # start from the initial grammar state and begin accepting tokens from the
+    # call after the one where they first appear. Returns the new row indices.
+    def add_rows(self, n=1):
+        start = len(self.states)
+        for _ in range(n):
+            with self.using_grammar():
+                state = self.grammar.init_state()
+            self.states.append(state)
+            self.histories.append((state, 0, None, None))
+            self.inputs.append(None)
+        return list(range(start, start + n))
+
+    # Drop rows that have left the batch. Remaining rows keep their relative
+    # order, matching how the caller compacts `input_ids`.
+    def remove_rows(self, rows):
+        rows = set(rows)
+        self.reorder([i for i in range(len(self.states)) if i not in rows])
 
-    def accept_token(self, token):
-        self.stacks = self.grammar.accept_token(token, self.stacks)
+    # Add copies of `rows` at the end of the batch, e.g. for parallel samples
+    # of one prompt. Returns the new row indices.
+    def fork(self, rows):
+        start = len(self.states)
+        self.reorder(list(range(start)) + list(rows))
+        return list(range(start, len(self.states)))
+
+    # Rebuild the batch so that row i continues old row `indices[i]`. Rows can
+    # be repeated or dropped: this is the beam reordering step of beam search.
+    def reorder(self, indices):
+        snapshot = self.snapshot()
+        self.restore([snapshot[i] for i in indices])
+
+    # The state of every row, to restore() later.
+    def snapshot(self):
+        return tuple(zip(self.histories, self.inputs))
+
+    def restore(self, snapshot):
+        self.histories = [history for history, _ in snapshot]
+        self.inputs = [inputs for _, inputs in snapshot]
+        self.states = [history[0] for history in self.histories]
+
+    # The stacks behind a row's current state.
+    def stacks(self, row=0):
+        return self.grammar.states[self.states[row]]
+
+    # Wait for this processor's background job, if any, and hold the
+    # grammar's lock, which other processors' jobs hold while they run.
+    @contextmanager
+    def using_grammar(self):
+        if self.pending is not None:
+            self.pending.wait()
+        with self.grammar.lock:
+            yield
+
+    def accept_token(self, token, row=0):
+        state = self.states[row]
+        # Finished rows (EOS accepted) keep receiving padding tokens.
+        if not self.grammar.is_finished(state):
+            with self.using_grammar():
+                state = self.grammar.next_state(state, token)
+        self.states[row] = state
+        history = self.histories[row]
+        self.histories[row] = (state, history[1] + 1, history, token)
+
+    # Undo the last `n` tokens accepted for a row.
+    def rollback(self, n, row=0):
+        history = self.histories[row]
+        if n > history[1]:
+            raise RuntimeError(
+                f"Input size changed: cannot roll back {n} tokens, "
+                f"only {history[1]} were accepted"
+            )
+        for _ in range(n):
+            history = history[2]
+        self.histories[row] = history
+        self.states[row] = history[0]
+        inputs = self.inputs[row]
+        if inputs is not None and inputs[2] > history[1]:
+            self.inputs[row] = (inputs[0], inputs[1], history[1])
+
+    # Speculative decoding: check a row's draft tokens against the grammar
+    # without accepting them. Returns the number n of leading draft tokens
+    # that the grammar accepts, and the packed masks for the n + 1 positions
+    # from the row's current state through those tokens. With `scores` (the
+    # target model's logits for the draft, one row per position), the masks
+    # are applied to its first n + 1 rows in place.
+    #
+    # Then add the tokens the caller keeps to `input_ids` as usual, or call
+    # accept_token for each; rollback() undoes them.
+    def verify(self, draft, row=0, scores=None):
+        with self.using_grammar():
+            states = self.grammar.draft_states(self.states[row], draft)
+            words = self.grammar.batch_acceptance(states)
+        if scores is not None:
+            apply_mask(scores[: len(states)], to_tensor(words, scores.device))
+        return len(states) - 1, words
+
+    # Jump-forward decoding: if the grammar forces the next bytes of a row,
+    # accept tokens for them right away and return them. The caller appends
+    # them to that row's `input_ids` instead of sampling them one forward pass
+    # at a time.
+    def jump_forward(self, row=0):
+        if self.grammar.is_finished(self.states[row]):
+            return []
+        with self.using_grammar():
+            tokens, _ = self.grammar.jump_forward(self.states[row])
+        for token in tokens:
+            self.accept_token(token, row)
+        return list(tokens)
+
+    # Accept the token just sampled for each row, ahead of the next call, and
+    # start computing the masks for the new states. The next call expects
+    # `input_ids` to already include these tokens.
+    def advance(self, tokens):
+        for row, token in enumerate(tokens):
+            self.accept_token(int(token), row)
+        if self.executor is not None and not self.top_k:
+            self.pending = self.grammar.masks_async(
+                self.states, self.executor, self.buffers
+            )
+
+    # Bring a row's history in line with its input ids.
+    def sync(self, row, ids):
+        history = self.histories[row]
+        inputs = self.inputs[row]
+        if inputs is None:
+            # the first call: everything so far is prompt
+            self.inputs[row] = (ids, len(ids) - history[1], history[1])
+            return
+        last_ids, offset, count = inputs
+
+        # tokens accepted since the last call, oldest first
+        extra = []
+        node = history
+        while node[1] > count:
+            extra.append(node[3])
+            node = node[2]
+        extra.reverse()
+
+        n = min(len(ids), offset + count)
+        mismatches = np.flatnonzero(ids[:n] != last_ids[:n])
+        common = int(mismatches[0]) if len(mismatches) else n
+        if common == offset + count:
+            for token in extra:
+                if common == len(ids) or ids[common] != token:
+                    break
+                common += 1
+
+        self.rollback(history[1] - (common - offset), row)
+        for token in ids[common:].tolist():
+            self.accept_token(token, row)
+        self.inputs[row] = (ids, offset, self.histories[row][1])
 
-    # TODO: batching
     def __call__(self, input_ids, scores):
-        if self.last_size is None:
-            pass
-        elif len(input_ids[0]) == self.last_size + 1:
-            self.stacks = self.grammar.accept_token(input_ids[0][-1], self.stacks)
-        else:
-            raise "Input size changed"
+        if len(input_ids) != len(self.states):
+            raise RuntimeError(
+                f"Batch size changed: expected {len(self.states)} rows, "
+                f"got {len(input_ids)}; use add_rows/remove_rows"
+            )
+
+        if torch.is_tensor(input_ids):
+            # a copy, since callers may reuse the tensor for the next step
+            input_ids = input_ids.cpu().numpy().astype(np.int64)
 
-        # TODO: the <s> token should be accounted for directly rather than just
-        # dropped here...
-        self.grammar.filter_logits(scores[0], self.stacks, scores.device)
+        # Even when the rows' states no longer match the pending masks, the
+        # job must finish before the caches are touched here.
+        with self.using_grammar():
+            for row, ids in enumerate(input_ids):
+                self.sync(row, np.asarray(ids, dtype=np.int64))
 
-        self.last_size = len(input_ids[0])
+            # TODO: the <s> token should be accounted for directly rather than
+            # just dropped here...
+            metrics = self.grammar.metrics
+            if metrics is not None:
+                self.grammar.observe_states(self.states)
+                st = time.perf_counter()
+            pending, self.pending = self.pending, None
+            if self.top_k:
+                self.grammar.filter_logits_top_k(scores, self.states, self.top_k)
+            elif pending is not None and pending.states == tuple(self.states):
+                apply_mask(scores, pending.result(scores.device))
+            else:
+                self.grammar.filter_logits_batch(scores, self.states)
+            if metrics is not None:
+                metrics.observe("filter_logits_seconds", time.perf_counter() - st)
         return scores
 
 
 class GrammarSampler:
-    def __init__(self, input_text, start_rule_name, tokenizer):
-        self.tt = 0
-        self.nt = 0
-        state = grammar_parser.parse(input_text)
-        src = state.out_grammar
-        self.start_rule_id = state.symbol_ids.get(start_rule_name)
-
+    # With `cache_dir`, the compiled grammar, token trie and every computed
+    # token mask are persisted under a key derived from the grammar text, start
+    # rule and tokenizer vocab. Later processes map them from disk instead of
+    # parsing, loading the vocab and traversing the trie again.
+    #
+    # `tokenizer` may also be a TokenTrie, e.g. one saved by a process that had
+    # the tokenizer and loaded with TokenTrie.load.
+    #
+    # With `optimize`, the grammar goes through the passes in grammar_optimizer
+    # before use; `optimization_report` says what each of them removed.
+    #
+    # `metrics` receives counters and timings (see metrics.py).
+    #
+    # Cached stacks, transitions and masks are kept within `host_cache_bytes`
+    # of host memory, and the masks uploaded to each device within
+    # `device_cache_bytes` (None for no limit). memory_usage() reports both.
+    def __init__(
+        self,
+        input_text,
+        start_rule_name,
+        tokenizer,
+        cache_dir=None,
+        optimize=True,
+        metrics=None,
+        host_cache_bytes=HOST_CACHE_BYTES,
+        device_cache_bytes=DEVICE_CACHE_BYTES,
+    ):
         self.eos_token_id = tokenizer.eos_token_id
-        self.token_trie = TokenTrie(tokenizer)
-        self.src = src
+        self.metrics = metrics
+        self.host_cache_bytes = host_cache_bytes
+        self.device_cache_bytes = device_cache_bytes
+
+        cache = None
+        if cache_dir is not None:
+            cache = GrammarCache.for_grammar(
+                cache_dir, input_text, start_rule_name, tokenizer, optimize
+            )
+
+        if cache is not None and cache.has_grammar():
+            self.load_grammar(cache, tokenizer)
+        else:
+            state = grammar_parser.parse(input_text)
+            self.start_rule_id = state.symbol_ids.get(start_rule_name)
+            self.optimization_report = None
+            if optimize:
+                state, self.optimization_report = optimize_grammar(
+                    state, self.start_rule_id
+                )
+            self.src = state.out_grammar
+            self.rules = self.find_rules(self.src)
+            if isinstance(tokenizer, TokenTrie):
+                self.token_trie = tokenizer
+            else:
+                self.token_trie = TokenTrie(tokenizer)
+            if cache is not None:
+                self.save_grammar(cache)
+
+        self.init_states(cache)
+
+    # Attach to a grammar that another process on this node published under
+    # `name` (see publish). The grammar, trie and mask table are mapped
+    # read-only from shared memory rather than copied, and masks computed here
+    # are appended to the shared table for everyone else.
+    #
+    # Raises RuntimeError if the directory doesn't hold the grammar its
+    # publisher recorded, or, given `key` (the publisher's grammar_key()), a
+    # different grammar.
+    @classmethod
+    def attach(
+        cls,
+        name,
+        shared_dir=None,
+        metrics=None,
+        host_cache_bytes=HOST_CACHE_BYTES,
+        device_cache_bytes=DEVICE_CACHE_BYTES,
+        key=None,
+    ):
+        cache = GrammarCache(shared_dir or default_shared_dir(), name)
+        if not cache.has_grammar():
+            raise FileNotFoundError(f"no grammar published at {cache.path}")
+        sampler = cls.__new__(cls)
+        sampler.metrics = metrics
+        sampler.host_cache_bytes = host_cache_bytes
+        sampler.device_cache_bytes = device_cache_bytes
+        sampler.load_grammar(cache)
+        recorded = cache.grammar_key()
+        if recorded != sampler.grammar_key() or key not in (None, recorded):
+            raise RuntimeError(
+                f"grammar published at {cache.path} doesn't match its key; "
+                "publish it again"
+            )
+        sampler.init_states(cache)
+        return sampler
+
+    # A digest of the compiled grammar and vocab (see grammar_cache).
+    def grammar_key(self):
+        return grammar_key(self.src, self.start_rule_id, self.token_trie)
+
+    # Publish this grammar under `name` in shared memory (a tmpfs directory,
+    # /dev/shm where there is one), along with the masks computed so far,
+    # for attach() in other processes. From now on this sampler also shares
+    # the mask table with them. Returns the published directory.
+    #
+    # A different grammar already published under `name` (say, by an earlier
+    # deploy) is replaced, masks and all.
+    def publish(self, name, shared_dir=None):
+        cache = GrammarCache(shared_dir or default_shared_dir(), name)
+        if cache.grammar_key() != self.grammar_key():
+            self.save_grammar(cache, replace=True)
+        self.masks = cache.open_masks(num_words(len(self.token_trie)))
+        for stack, words in self.caches["token_acceptance_for_stack"].items():
+            key = self.stack_digest(stack)
+            if self.masks.get(key) is None:
+                self.masks.add(key, words)
+        return cache.path
+
+    # A TokenTrie passed as `tokenizer` is used as is if it is for the
+    # grammar's vocab (as with a GrammarRegistry); otherwise the vocab's trie
+    # is mapped from the cache.
+    def load_grammar(self, cache, tokenizer=None):
+        meta, arrays = cache.load_grammar()
+        self.eos_token_id = meta["eos_token_id"]
+        self.start_rule_id = meta["start_rule_id"]
+        self.optimization_report = meta["optimization_report"]
+        self.src = arrays["src"].tolist()
+        self.rules = [None if pos < 0 else pos for pos in arrays["rules"].tolist()]
+        if (
+            isinstance(tokenizer, TokenTrie)
+            and tokenizer.fingerprint() == meta["vocab"]
+        ):
+            self.token_trie = tokenizer
+        else:
+            self.token_trie = cache.load_vocab(meta["vocab"])
+
+    def init_states(self, cache):
+        self.start_rule = self.rules[self.start_rule_id]
+        self.regular = RegularRules(self.src, self.rules, self.start_rule_id)
+        self.states = []
+        self.state_ids = {}
+        self.state_bytes = 0
+        self.caches = CachePool(self.host_cache_bytes)
+        self.mask_tables = {}
+        self.masks = None
+        # held by background mask jobs (see masks_async) and by logits
+        # processors while they use the caches
+        self.lock = threading.RLock()
+        if cache is not None:
+            self.masks = cache.open_masks(num_words(len(self.token_trie)))
 
+    # Map each rule id to the position of its definition in the binary grammar.
+    @staticmethod
+    def find_rules(src):
         pos = 0
         rules = []
 
@@ -57,28 +434,79 @@ class GrammarSampler:
                 pos += 1 + src[pos]
             pos += 1
 
-        self.start_rule = rules[self.start_rule_id]
-        self.rules = rules
+        return rules
 
-    def logits_processor(self):
-        return LogitsProcessor(self)
+    def save_grammar(self, cache, replace=False):
+        cache.save_vocab(self.token_trie)
+        arrays = {
+            "src": np.array(self.src, dtype=np.int32),
+            "rules": np.array(
+                [-1 if pos is None else pos for pos in self.rules], dtype=np.int32
+            ),
+        }
+        meta = {
+            "vocab": self.token_trie.fingerprint(),
+            "eos_token_id": self.eos_token_id,
+            "start_rule_id": self.start_rule_id,
+            "optimization_report": self.optimization_report,
+            "key": self.grammar_key(),
+        }
+        cache.save_grammar(meta, arrays, replace)
 
+    def logits_processor(self, batch_size=1, top_k=None, executor=None):
+        return LogitsProcessor(self, batch_size, top_k, executor)
+
+    # Stacks are graph-structured (see graph_stack); a set of stacks is a
+    # frozenset of nodes with at most one node per top position.
     def init_stacks(self):
-        stack = [self.start_rule + 2]
-        return self.advance_stack(tuple(stack))
+        return merge(self.expand_rule(self.start_rule_id, frozenset([EMPTY])))
+
+    # The stacks for starting each alternative of a rule, on top of `below`.
+    # Regular rules start in their DFA instead (see regular.py).
+    def expand_rule(self, rule_id, below):
+        start = self.regular.start(rule_id)
+        if start is not None:
+            return self.advance_stack((start, below))
+        subpos = self.rules[rule_id] + 1
+        stacks = []
+        while self.src[subpos]:
+            if self.src[subpos + 1]:
+                stacks.extend(self.advance_stack((subpos + 1, below)))
+            else:
+                # empty alternative: the symbol below is next
+                for stk in below:
+                    stacks.extend(self.advance_stack(stk))
+            subpos += 1 + self.src[subpos]
+        return stacks
 
     # For each stack, resolve rules to find the actual characters that are
     # accepted by this stack (not the set of sub-rules).
-    @lru_cache(maxsize=32768)
+    @cached
     def advance_stack(self, stack):
-        stack = list(stack)
-        if len(stack) == 0:
-            return [stack]
+        if self.metrics is None:
+            return self.resolve_stack(stack)
+        st = time.perf_counter()
+        stacks = self.resolve_stack(stack)
+        self.metrics.observe("advance_stack_seconds", time.perf_counter() - st)
+        return stacks
+
+    def resolve_stack(self, stack):
+        if not stack:
+            return frozenset([stack])
 
-        pos = stack[-1]
+        pos, parents = stack
+
+        if self.regular.is_virtual(pos):
+            if not self.regular.is_accepting(pos):
+                return frozenset([stack])
+            # The rule can end here, so what follows it can start too.
+            stacks = [stack]
+            for parent in parents:
+                stacks.extend(self.advance_stack(parent))
+            return merge(stacks)
 
         if self.src[pos] > 1:
-            return [stack]
+            return frozenset([stack])
 
         # The stack head is a nonterminal (a rule reference).
         # Resolving this rule gives a set of one or more possible positions
@@ -86,18 +514,12 @@ class GrammarSampler:
         # We pop the current rule off the stack and, for each option, push:
         # - the symbol following this symbol in the current rule; then
         # - the first symbol of the resolved rule.
-        referenced_rule_id = self.src[pos + 1]
-        subpos = self.rules[referenced_rule_id] + 1
-        stacks = []
-        while self.src[subpos]:
-            new_stack = stack[:-1]
-            if self.src[pos + 2]:
-                new_stack.append(pos + 2)
-            if self.src[subpos + 1]:
-                new_stack.append(subpos + 1)
-            stacks.extend(self.advance_stack(tuple(new_stack)))
-            subpos += 1 + self.src[subpos]
-        return stacks
+        # The node for the following symbol is shared by every option.
+        if self.src[pos + 2]:
+            below = frozenset([(pos + 2, parents)])
+        else:
+            below = parents
+        return merge(self.expand_rule(self.src[pos + 1], below))
 
     def accept(self, byte, stacks):
         new_stacks = []
@@ -105,41 +527,139 @@ class GrammarSampler:
             if not stack:
                 continue
 
-            pos = stack[-1]
-            num_chars = self.src[pos]
-
-            pos += 1
-            found = False
-            for i in range(0, num_chars, 2):
-                if self.src[pos + i] <= byte and byte <= self.src[pos + i + 1]:
-                    found = True
-                    break
-            if not found:
+            pos, parents = stack
+            if self.regular.is_virtual(pos):
+                pos = self.regular.step(pos, byte)
+                if pos is not None:
+                    new_stacks.extend(self.advance_stack((pos, parents)))
+                continue
+            if not self.pos_char_acceptance(pos)[byte]:
                 continue
 
-            pos += num_chars
-            new_stack = stack[:-1]
+            pos += self.src[pos] + 1
             if self.src[pos]:
-                new_stack.append(pos)
-            new_stacks.extend(self.advance_stack(tuple(new_stack)))
+                new_stacks.extend(self.advance_stack((pos, parents)))
+            else:
+                for parent in parents:
+                    new_stacks.extend(self.advance_stack(parent))
 
-        return new_stacks
+        return merge(new_stacks)
 
     def accept_token(self, token, stacks):
         if token == self.eos_token_id:
-            if any(len(stack) == 0 for stack in stacks):
-                return []
-            raise Exception(f"EOS token not accepted with PDA stacks: {stacks}")
+            if EMPTY in stacks:
+                return frozenset()
+            raise Exception(
+                "EOS token not accepted with PDA stacks: "
+                f"{[s for stk in stacks for s in linearize(stk)]}"
+            )
 
         for byte in self.token_trie.id2str(token):
             stacks = self.accept(byte, stacks)
-            assert stacks != []
+            assert stacks
 
         return stacks
 
+    # Each distinct set of stacks reached while decoding is interned as a small
+    # integer state id. `self.states` maps ids back to their stacks. Rows and
+    # caches refer to states by id, so they are never evicted, but their
+    # memory is counted in memory_usage().
+    def intern_state(self, stacks):
+        stacks = frozenset(stacks)
+        state = self.state_ids.get(stacks)
+        if state is None:
+            state = self.state_ids[stacks] = len(self.states)
+            self.states.append(stacks)
+            self.state_bytes += value_size(stacks) + ENTRY_BYTES
+        return state
+
+    def init_state(self):
+        return self.intern_state(self.init_stacks())
+
+    # A state whose stacks are empty has accepted EOS.
+    def is_finished(self, state):
+        return not self.states[state]
+
+    # Token-level transition table, filled lazily: once warm, advancing a
+    # state by a token is a lookup instead of replaying its bytes through the
+    # PDA.
+    @cached
+    def next_state(self, state, token):
+        return self.intern_state(self.accept_token(token, self.states[state]))
+
+    # Whether a single token can follow a state, found by walking only that
+    # token's bytes. Agrees with the state's full mask.
+    @cached
+    def accepts_token(self, state, token):
+        stacks = self.states[state]
+        if token == self.eos_token_id:
+            return EMPTY in stacks
+        if token not in self.token_trie:
+            return False
+        return self.accepts_bytes(self.token_trie.id2str(token), stacks)
+
+    def accepts_bytes(self, data, stacks):
+        for byte in data:
+            stacks = self.accept(byte, stacks)
+            if not stacks:
+                return False
+        return True
+
+    # The states after each of the leading draft tokens that the grammar
+    # accepts, starting with `state` itself. Stops after EOS.
+    def draft_states(self, state, draft):
+        states = [state]
+        for token in draft:
+            token = int(token)
+            if self.is_finished(state) or not self.accepts_token(state, token):
+                break
+            state = self.next_state(state, token)
+            states.append(state)
+        return states
+
+    # The bytes a state forces: while exactly one byte can come next, and the
+    # state can't end instead, that byte is part of the run.
+    @cached
+    def forced_bytes(self, state):
+        stacks = self.states[state]
+        run = bytearray()
+        while stacks and EMPTY not in stacks and len(run) < MAX_FORCED_BYTES:
+            acceptance = np.any(
+                [self.pos_char_acceptance(stack[0]) for stack in stacks], axis=0
+            )
+            (allowed,) = np.nonzero(acceptance)
+            if len(allowed) != 1:
+                break
+            byte = int(allowed[0])
+            run.append(byte)
+            stacks = self.accept(byte, stacks)
+        return bytes(run)
+
+    # Tokenize a state's forced bytes, taking the longest token at each step,
+    # and advance past them. Returns the tokens and the state after them. A
+    # tail that no token fits entirely inside is left for sampling.
+    @cached
+    def jump_forward(self, state):
+        run = self.forced_bytes(state)
+        tokens = []
+        pos = 0
+        while pos < len(run):
+            token, length = NO_TOKEN, 0
+            for token_id, n in self.token_trie.prefixes(run[pos:]):
+                if token_id != self.eos_token_id:
+                    token, length = token_id, n
+            if token == NO_TOKEN:
+                break
+            tokens.append(token)
+            state = self.next_state(state, token)
+            pos += length
+        return tuple(tokens), state
+
     # For each sub-rule in the grammar, cache whether each byte is accepted.
-    @lru_cache(maxsize=None)
+    @cached
     def pos_char_acceptance(self, pos):
+        if self.regular.is_virtual(pos):
+            return self.regular.char_acceptance(pos)
         acceptance = [False] * 256
         num_chars = self.src[pos]
         pos += 1
@@ -150,63 +670,394 @@ class GrammarSampler:
                 acceptance[j] = True
         return acceptance
 
-    # Probably this should be configurable. If the grammar has an exceedingly
-    # large number of states, the correct setting is a tradeoff between GPU
-    # RAM usage and recomputation time.
+    # Masks are cached packed (see masks.py), at 1 bit per token, within the
+    # sampler's host cache budget. Traversals that took long are the last to be
+    # evicted.
+    @cached
+    def token_acceptance_for_stack(self, stack):
+        if self.masks is not None:
+            key = self.stack_digest(stack)
+            words = self.masks.get(key)
+            if words is not None:
+                if self.metrics is not None:
+                    self.metrics.count("masks_from_disk")
+                return words
+
+        words = self.compute_token_acceptance(stack)
+        if self.masks is not None:
+            self.masks.add(key, words)
+        return words
+
+    # Traverse the token trie from one stack, bypassing every cache. Stacks in
+    # a regular rule's DFA use its token table instead, as do stacks on a
+    # character class that loops back to itself (see loop_successors).
+    def compute_token_acceptance(self, stack):
+        st = time.perf_counter()
+        if stack and self.regular.is_virtual(stack[0]):
+            metric = "dfa_mask_seconds"
+            accepts = self.dfa_token_acceptance(stack)
+        else:
+            others = self.loop_successors(stack)
+            if others is not None:
+                metric = "loop_mask_seconds"
+                accepts = self.loop_token_acceptance(stack, others)
+            else:
+                metric = "traverse_seconds"
+                accepts = np.zeros(len(self.token_trie), dtype=bool)
+                accepts[self.token_trie.traverse([stack], self.accept)] = True
+        accepts[self.eos_token_id] = not stack
+        words = pack(accepts)
+        if self.metrics is not None:
+            self.metrics.count("masks_computed")
+            self.metrics.observe(metric, time.perf_counter() - st)
+        return words
+
+    # For a DFA position: the packed mask of the tokens whose bytes all stay in
+    # the DFA, and the tokens that can leave it part way through, as
+    # {first byte after leaving: {remaining bytes: [token ids]}}. Shared by
+    # every stack with this position on top, whatever is below it.
+    @cached
+    def dfa_token_table(self, pos):
+        _, lengths, matrix = self.token_trie.padded_bytes()
+        return self.token_table(*self.regular.run_tokens(pos, lengths, matrix))
+
+    def token_table(self, full, exit_rows, exit_offsets):
+        token_ids, _, _ = self.token_trie.padded_bytes()
+        accepts = np.zeros(len(self.token_trie), dtype=bool)
+        accepts[token_ids[full]] = True
+        exits = {}
+        tokens = self.token_trie.tokens
+        for token_id, offset in zip(
+            token_ids[exit_rows].tolist(), exit_offsets.tolist()
+        ):
+            rest = tokens[token_id][offset:]
+            exits.setdefault(rest[0], {}).setdefault(rest, []).append(token_id)
+        return pack(accepts), exits
+
+    def dfa_token_acceptance(self, stack):
+        pos, parents = stack
+        below = merge(s for parent in parents for s in self.advance_stack(parent))
+        return self.table_acceptance(self.dfa_token_table(pos), below)
+
+    # The tokens accepted from a token table (see dfa_token_table), given the
+    # stacks that a token leaving part way through continues on.
+    def table_acceptance(self, table, below):
+        words, exits = table
+        accepts = unpack(words, len(self.token_trie)).copy()
+        first_bytes = np.zeros(256, dtype=bool)
+        for s in below:
+            if s:
+                first_bytes |= self.pos_char_acceptance(s[0])
+        for byte, rests in exits.items():
+            if not first_bytes[byte]:
+                continue
+            for rest, token_ids in rests.items():
+                if self.accepts_bytes(rest, below):
+                    accepts[token_ids] = True
+        return accepts
+
+    # A character class whose rule continues with a tail reference back to an
+    # alternative starting with the same class (`x ::= [a-z] x | ...`) leaves
+    # its stack unchanged after any byte it accepts. If that is the case for
+    # this stack, returns the other stacks that such a byte leads to, where
+    # tokens can leave the loop; otherwise None. Loops in regular rules are
+    # already in a DFA, so this only comes up in rules that also nest.
+    def loop_successors(self, stack):
+        if not stack:
+            return None
+        pos, parents = stack
+        if self.src[pos] < 2:
+            return None
+        pos += self.src[pos] + 1
+        if self.src[pos]:
+            after = self.advance_stack((pos, parents))
+        else:
+            after = merge(s for parent in parents for s in self.advance_stack(parent))
+        if stack not in after:
+            return None
+        return after - {stack}
+
+    # For each distinct character class, the token table of a one-state DFA
+    # that loops on it: the tokens made up entirely of bytes in the class, and
+    # where tokens with a prefix in the class can leave the loop. Computed
+    # with NumPy over the padded token bytes rather than by trie traversal.
+    @cached
+    def class_token_table(self, ranges):
+        acceptance = np.zeros(256, dtype=bool)
+        for start, end in zip(ranges[::2], ranges[1::2]):
+            acceptance[start : end + 1] = True
+        delta = np.where(acceptance, 0, REJECT).astype(np.int32).reshape(1, 256)
+        _, lengths, matrix = self.token_trie.padded_bytes()
+        exits = run_dfa(delta, np.ones(1, dtype=bool), 0, lengths, matrix)
+        return self.token_table(*exits)
+
+    def loop_token_acceptance(self, stack, others):
+        pos = stack[0]
+        ranges = tuple(self.src[pos + 1 : pos + 1 + self.src[pos]])
+        return self.table_acceptance(self.class_token_table(ranges), others)
+
+    # Warm the mask cache ahead of time, e.g. at deploy time, so that live
+    # traffic doesn't pay for trie traversals.
     #
-    # The main variable that pushes usage up here is number of states in the
-    # grammar.
-    @lru_cache(maxsize=32768)
-    def token_acceptance_for_stack(self, stack, device):
+    # States reachable from init_state() are explored breadth-first, one byte
+    # at a time (any byte can start a token), until their stacks number
+    # `max_stacks` or `budget` seconds pass. Masks for those stacks are computed across `workers` processes
+    # (default: one per available CPU; 0 or 1 computes in this process) and
+    # kept in the mask cache, and in the persistent cache if there is one.
+    # Returns counts of what was done.
+    def precompile(self, budget=None, max_stacks=4096, workers=None):
         st = time.time()
-        stack = list(stack)  # needs to come in as a tuple for lru_cache
+        deadline = None if budget is None else st + budget
 
-        accepts = [False] * len(self.token_trie)
-        accepts[self.eos_token_id] = len(stack) == 0
+        # Decoding reaches merged sets of stacks (see graph_stack), not the
+        # stacks of each parse on their own, so the walk is over whole states.
+        states = [self.init_state()]
+        seen = set(states)
+        stacks = []
+        seen_stacks = set()
+        i = 0
+        while i < len(states) and len(stacks) < max_stacks:
+            if deadline is not None and time.time() > deadline:
+                break
+            state_stacks = self.states[states[i]]
+            i += 1
+            accepted = set()
+            for stack in state_stacks:
+                if stack not in seen_stacks:
+                    seen_stacks.add(stack)
+                    stacks.append(stack)
+                if stack:
+                    acceptance = self.pos_char_acceptance(stack[0])
+                    accepted.update(b for b in range(256) if acceptance[b])
+            for byte in sorted(accepted):
+                next_stacks = self.accept(byte, state_stacks)
+                if next_stacks:
+                    state = self.intern_state(next_stacks)
+                    if state not in seen:
+                        seen.add(state)
+                        states.append(state)
+        stacks = stacks[:max_stacks]
 
-        def traverse_trie(trie, stacks):
-            for byte, next_trie in trie.items():
-                if byte == LEAF:
-                    token_id = next_trie
-                    if token_id != self.eos_token_id:
-                        accepts[token_id] = bool(stacks)
-                    continue
+        todo = [stack for stack in stacks if not self.has_mask(stack)]
+        todo.reverse()  # pop() in breadth-first order
+        computed = 0
+        if workers is None:
+            workers = (
+                len(os.sched_getaffinity(0))
+                if hasattr(os, "sched_getaffinity")
+                else os.cpu_count()
+            )
+        if workers is None or workers <= 1:
+            while todo and (deadline is None or time.time() < deadline):
+                stack = todo.pop()
+                self.store_precompiled(stack, *_timed_acceptance(self, stack))
+                computed += 1
+        elif todo:
+            # Keep a few tasks per worker in flight, so that the budget is
+            # overshot by at most one round of them.
+            pool = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(self,)
+            )
+            pending = {}
+            try:
+                while todo or pending:
+                    out_of_time = deadline is not None and time.time() >= deadline
+                    while todo and not out_of_time and len(pending) < 4 * workers:
+                        stack = todo.pop()
+                        pending[pool.submit(_worker_acceptance, stack)] = stack
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.store_precompiled(pending.pop(future), *future.result())
+                        computed += 1
+            finally:
+                pool.shutdown(cancel_futures=True)
 
-                new_stacks = []
-                for stk in stacks:
-                    if not stk:
-                        continue
+        return {
+            "states": i,
+            "stacks": len(stacks),
+            "computed": computed,
+            "seconds": time.time() - st,
+        }
+
+    # Digests of deep stacks share the work for their common suffixes through
+    # this cache.
+    @cached
+    def stack_digest(self, stack):
+        return digest(stack, self.caches["stack_digest"].peek)
+
+    def has_mask(self, stack):
+        if self.caches["token_acceptance_for_stack"].peek(stack) is not None:
+            return True
+        return (
+            self.masks is not None
+            and self.masks.get(self.stack_digest(stack)) is not None
+        )
 
-                    pos = stk[-1]
-                    num_chars = self.src[pos]
+    def store_precompiled(self, stack, words, cost):
+        self.caches["token_acceptance_for_stack"].put(stack, words, cost)
+        if self.masks is not None:
+            self.masks.add(self.stack_digest(stack), words)
 
-                    if not self.pos_char_acceptance(pos)[byte]:
-                        continue
+    # Samplers are sent to precompile workers; the mask file belongs to the
+    # process that opened it.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["masks"] = None
+        state["caches"] = CachePool(self.host_cache_bytes)
+        state["mask_tables"] = {}
+        state["metrics"] = None
+        del state["lock"]
+        return state
 
-                    pos += num_chars + 1
-                    new_stack = stk[:-1]
-                    if self.src[pos]:
-                        new_stack.append(pos)
-                    new_stacks.extend(self.advance_stack(tuple(new_stack)))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
 
-                if new_stacks:
-                    traverse_trie(next_trie, new_stacks)
+    # Merge stacks: a token is accepted if any stack accepts it.
+    def packed_acceptance(self, stacks):
+        return np.bitwise_or.reduce(
+            [self.token_acceptance_for_stack(stack) for stack in stacks], axis=0
+        )
 
-        traverse_trie(self.token_trie.trie, [stack])
+    # The merged mask of a state. This is a second cache level on top of the
+    # per-stack one: repetitive grammars keep returning to the same states
+    # (e.g. after every `eol` in `(commands eol)+`), and those steps then cost
+    # one lookup instead of one per stack plus the OR-reduction. Callers must
+    # not modify the returned words.
+    @cached
+    def state_acceptance(self, state):
+        return self.packed_acceptance(self.states[state])
 
-        et = time.time() - st
-        x = torch.tensor(accepts, dtype=torch.bool, device=device)
-        self.tt += et
-        self.nt += 1
-        return x
+    # Resolve a set of stacks to a tensor of True/False for each token
+    # indicating acceptance.
+    def acceptance_for_stacks(self, stacks, device):
+        words = to_tensor(self.state_acceptance(self.intern_state(stacks)), device)
+        return unpack_tensor(words, len(self.token_trie))
 
     def filter_logits(self, logits, stacks, device):
-        # resolve each stack to a tensor of True/False for each token
-        # indicating acceptance
-        acceptance = torch.cat(
-            [self.token_acceptance_for_stack(tuple(stack), device) for stack in stacks]
-        )
-        # Merge stacks: any True => True
-        acceptance = acceptance.reshape(len(stacks), -1).any(dim=0)
-        # Logits to -inf where False
-        logits[~acceptance] = -inf
+        self.filter_logits_batch(logits.view(1, -1), [self.intern_state(stacks)])
+
+    # batch_acceptance for a background job, under the grammar's lock.
+    def locked_batch_acceptance(self, states, out):
+        with self.lock:
+            return self.batch_acceptance(states, out)
+
+    # Packed masks for a batch of states, one row per state. Finished rows
+    # accept everything.
+    def batch_acceptance(self, states, out=None):
+        if out is None:
+            out = np.empty((len(states), num_words(len(self.token_trie))), dtype=WORD)
+        for row, state in enumerate(states):
+            out[row] = ALL if self.is_finished(state) else self.state_acceptance(state)
+        return out
+
+    # The device-resident table of state masks (see masks.MaskTable).
+    def mask_table(self, device):
+        device = torch.device(device)
+        table = self.mask_tables.get(device)
+        if table is None:
+            words = num_words(len(self.token_trie))
+            max_rows = None
+            if self.device_cache_bytes is not None:
+                max_rows = self.device_cache_bytes // (8 * words)
+            table = MaskTable(words, device, max_rows=max_rows)
+            self.mask_tables[device] = table
+        return table
+
+    # Mask a whole (batch, vocab) score tensor in place, one state per row.
+    # The masks of states stay on the device between steps, so a step sends
+    # only the batch's row indices, then does one index_select and one
+    # masked_fill_. Finished rows are left unmasked. Columns past the end of
+    # the tokenizer's vocab (padded model vocabs) are never accepted.
+    def filter_logits_batch(self, scores, states):
+        table = self.mask_table(scores.device)
+        keys = [None if self.is_finished(state) else state for state in states]
+        if self.metrics is None:
+            rows = table.index(keys, self.state_acceptance)
+            apply_mask(scores, table.gather(rows))
+            return
+        # Compute missing masks first, so that the upload is timed on its own.
+        for key in keys:
+            if key not in table.rows:
+                self.state_acceptance(key)
+        st = time.perf_counter()
+        words = table.gather(table.index(keys, self.state_acceptance))
+        self.metrics.observe("upload_seconds", time.perf_counter() - st)
+        apply_mask(scores, words)
+
+    # Start computing batch_acceptance(states) on `executor`, writing into a
+    # host buffer from `buffers` (an async_masks.HostBuffers). Returns a
+    # MaskFuture.
+    def masks_async(self, states, executor, buffers):
+        states = tuple(states)
+        buffer = buffers.get(len(states), num_words(len(self.token_trie)))
+        out = buffer.numpy().view(WORD)
+        future = executor.submit(self.locked_batch_acceptance, states, out)
+        return MaskFuture(future, states, buffer)
+
+    # Lazy masking: for each row, check only the `k` highest-scoring tokens
+    # against the grammar, and keep those that are accepted. The full mask is
+    # computed only for rows where all `k` are rejected.
+    #
+    # For greedy decoding this is exact: the best accepted candidate is the
+    # best accepted token overall, since every token outside the top k scores
+    # lower. For sampling it is approximate: accepted tokens outside the top k
+    # are masked out, so the distribution is truncated much like top-k
+    # sampling.
+    def filter_logits_top_k(self, scores, states, k):
+        vocab_size = len(self.token_trie)
+        k = min(k, vocab_size)
+        candidates = scores[:, :vocab_size].topk(k, dim=-1).indices.tolist()
+        words = np.empty((len(states), num_words(vocab_size)), dtype=WORD)
+        for row, state in enumerate(states):
+            if self.is_finished(state):
+                words[row] = ALL
+                continue
+            accepted = [t for t in candidates[row] if self.accepts_token(state, t)]
+            if accepted:
+                accepts = np.zeros(vocab_size, dtype=bool)
+                accepts[accepted] = True
+                words[row] = pack(accepts)
+            else:
+                words[row] = self.state_acceptance(state)
+        if self.metrics is None:
+            apply_mask(scores, to_tensor(words, scores.device))
+            return
+        st = time.perf_counter()
+        words = to_tensor(words, scores.device)
+        self.metrics.observe("upload_seconds", time.perf_counter() - st)
+        apply_mask(scores, words)
+
+    # Record the number of live stacks and the deepest stack of each row.
+    def observe_states(self, states):
+        for state in states:
+            stacks = self.states[state]
+            self.metrics.observe("stacks", len(stacks))
+            self.metrics.observe(
+                "stack_depth", max(map(self.stack_depth, stacks), default=0)
+            )
+
+    @cached
+    def stack_depth(self, stack):
+        return depth(stack, self.caches["stack_depth"].peek)
+
+    # Hits, misses, evictions, entries and bytes of each cache.
+    def cache_stats(self):
+        stats = self.caches.stats()
+        for device, table in self.mask_tables.items():
+            stats[f"mask_table[{device}]"] = table.stats()
+        return stats
+
+    # Bytes held on the host (by the caches, precompiled masks included, and
+    # by interned states, which are also given on their own), and by the mask
+    # table on each device.
+    def memory_usage(self):
+        return {
+            "host": self.caches.usage + self.state_bytes,
+            "states": self.state_bytes,
+            "devices": {
+                str(device): table.nbytes for device, table in self.mask_tables.items()
+            },
+        }
@@ -0,0 +1,111 @@
+# Graph-structured stacks.
+#
+# A PDA stack is represented as a node `(pos, parents)`, where `pos` is the
+# grammar position on top of the stack and `parents` is a frozenset of the
+# nodes that can be below it. The empty stack is `EMPTY`.
+#
+# Stacks that share a suffix share the node objects for it, so pushing and
+# popping never copies a stack. After each step, stacks with the same top
+# position are merged into one node by unioning their parents. The number of
+# live stacks is then bounded by the number of distinct grammar positions
+# rather than by the number of parses, as in GLR and Earley parsers.
+#
+# Nodes are plain tuples and frozensets, so they are hashable (and usable as
+# cache keys), compare by value and pickle cleanly. Frozensets cache their
+# hash, so hashing a node is O(1) no matter how deep it is.
+
+import hashlib
+
+EMPTY = ()
+
+
+# Merge an iterable of stacks into a frozenset with at most one node per top
+# position.
+def merge(stacks):
+    stacks = stacks if isinstance(stacks, (list, tuple)) else list(stacks)
+    if len(stacks) < 2:
+        return frozenset(stacks)
+
+    by_pos = {}
+    for stack in stacks:
+        if not stack:
+            by_pos[None] = EMPTY
+            continue
+        pos, parents = stack
+        seen = by_pos.get(pos)
+        if seen is None:
+            by_pos[pos] = parents
+        elif seen is not parents:
+            by_pos[pos] = seen | parents
+
+    merged = []
+    for pos, parents in by_pos.items():
+        merged.append(EMPTY if pos is None else (pos, parents))
+    return frozenset(merged)
+
+
+# Length of the longest linear stack through this node.
+def depth(stack, known=None):
+    return fold(stack, combine_depth, known)
+
+
+def combine_depth(node, parent_depths):
+    return 1 + max(parent_depths) if node else 0
+
+
+# Enumerate the linear stacks (bottom first, as lists of positions) that a
+# node stands for. This can be exponential in the depth of the graph and is
+# meant for debugging and error messages.
+def linearize(stack):
+    if not stack:
+        yield []
+        return
+    pos, parents = stack
+    for parent in parents:
+        for below in linearize(parent):
+            yield below + [pos]
+
+
+# Compute a value for each node below `stack`, bottom up, as
+# `combine(node, parent_values)`, and return the one for `stack`. Iterative,
+# since JSON-like grammars can nest stacks thousands of nodes deep. `known`
+# can return an already computed value for a node (or None), so that callers
+# memoizing the result per stack don't revisit shared suffixes.
+def fold(stack, combine, known=None):
+    values = {}
+    todo = [stack]
+    while todo:
+        node = todo[-1]
+        if node in values:
+            todo.pop()
+            continue
+        if known is not None and node:
+            value = known(node)
+            if value is not None:
+                values[node] = value
+                todo.pop()
+                continue
+        parents = node[1] if node else ()
+        pending = [parent for parent in parents if parent not in values]
+        if pending:
+            todo.extend(pending)
+            continue
+        todo.pop()
+        values[node] = combine(node, [values[parent] for parent in parents])
+    return values[stack]
+
+
+def combine_digest(node, parent_digests):
+    h = hashlib.blake2b(digest_size=16)
+    if node:
+        h.update(node[0].to_bytes(4, "little"))
+        for parent_digest in sorted(parent_digests):
+            h.update(parent_digest)
+    return h.digest()
+
+
+# A stable 16-byte digest of a stack, independent of set iteration order and
+# of the process that built it, for keying masks persisted outside this
+# process.
+def digest(stack, known=None):
+    return fold(stack, combine_digest, known)
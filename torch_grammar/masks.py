@@ -0,0 +1,171 @@
+from math import inf
+import numpy as np
+import torch
+
+# Token masks are stored as packed bitsets: bit (i % 64) of word (i // 64) is
+# set when token i is accepted. Words are little-endian uint64 so that the
+# same bytes can be written to and mapped from disk on any host.
+WORD = np.dtype("<u8")
+ALL = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def num_words(vocab_size):
+    return (vocab_size + 63) // 64
+
+
+def pack(accepts):
+    bits = np.packbits(np.asarray(accepts, dtype=bool), bitorder="little")
+    words = np.zeros(num_words(len(accepts)), dtype=WORD)
+    words.view(np.uint8)[: len(bits)] = bits
+    return words
+
+
+def unpack(words, vocab_size):
+    bits = np.unpackbits(
+        np.asarray(words, dtype=WORD).view(np.uint8),
+        count=vocab_size,
+        bitorder="little",
+    )
+    return bits.view(bool)
+
+
+# Packed masks go to the device as int64 (torch has no general-purpose uint64);
+# the bit patterns are identical.
+def to_tensor(words, device):
+    words = np.ascontiguousarray(words, dtype=np.uint64).view(np.int64)
+    return torch.from_numpy(words).to(device, non_blocking=True)
+
+
+_SHIFTS = {}
+
+
+# Expand (..., num_words) int64 words to (..., size) bools. Bits past the end of
+# the packed words (e.g. a model vocab padded beyond the tokenizer's) are False.
+def unpack_tensor(words, size):
+    shifts = _SHIFTS.get(words.device)
+    if shifts is None:
+        shifts = _SHIFTS[words.device] = torch.arange(64, device=words.device)
+    bits = ((words.unsqueeze(-1) >> shifts) & 1).flatten(-2).bool()
+    if bits.shape[-1] < size:
+        bits = torch.nn.functional.pad(bits, (0, size - bits.shape[-1]))
+    return bits[..., :size]
+
+
+# Set scores of rejected tokens to -inf in place.
+def apply(scores, words):
+    scores.masked_fill_(~unpack_tensor(words, scores.shape[-1]), -inf)
+
+
+# Packed masks kept on a device, one row per grammar state, so that a step
+# only sends the row indices of the batch's states. Row 0, keyed None, accepts
+# everything (for finished rows). The table doubles in size when it fills up,
+# up to `max_rows` (None for no limit); past that, the least recently used rows
+# are reused. A batch that needs more distinct rows than that still gets them.
+class MaskTable:
+    def __init__(self, num_words, device, capacity=256, max_rows=None):
+        self.device = device
+        self.max_rows = max_rows
+        if max_rows is not None:
+            capacity = max(2, min(capacity, max_rows))
+        self.words = torch.empty(
+            (capacity, num_words), dtype=torch.int64, device=device
+        )
+        self.words[0] = -1
+        self.rows = {None: 0}
+        self.keys = [None]
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.step = 0
+        self.size = 1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return self.words.element_size() * self.words.nelement()
+
+    # The table rows for `keys`, uploading the masks of keys not seen before
+    # (given by `lookup(key)` as packed words) in one copy.
+    def index(self, keys, lookup):
+        self.step += 1
+        missing = [key for key in dict.fromkeys(keys) if key not in self.rows]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if missing:
+            rows = self.allocate(len(missing), keys)
+            words = np.stack([lookup(key) for key in missing])
+            words = to_tensor(words, self.device)
+            if rows == list(range(rows[0], rows[0] + len(rows))):
+                self.words[rows[0] : rows[0] + len(rows)] = words
+            else:
+                index = torch.tensor(rows, dtype=torch.int64, device=self.device)
+                self.words.index_copy_(0, index, words)
+            for row, key in zip(rows, missing):
+                self.rows[key] = row
+                self.keys[row] = key
+        rows = [self.rows[key] for key in keys]
+        self.last_used[rows] = self.step
+        return rows
+
+    # Free rows for `n` new keys: new rows while under max_rows, then the
+    # least recently used rows of keys other than `keep`.
+    def allocate(self, n, keep):
+        limit = n + self.size if self.max_rows is None else self.max_rows
+        grow = max(0, min(n, limit - self.size))
+        rows = list(range(self.size, self.size + grow))
+        self.reserve(self.size + grow)
+        self.keys.extend([None] * grow)
+        self.size += grow
+        if len(rows) < n:
+            keep = {self.rows[key] for key in keep if key in self.rows}
+            keep.update(rows)
+            keep.add(0)
+            order = np.argsort(self.last_used[: self.size], kind="stable")
+            for row in order.tolist():
+                if len(rows) == n:
+                    break
+                if row in keep:
+                    continue
+                del self.rows[self.keys[row]]
+                self.keys[row] = None
+                self.evictions += 1
+                rows.append(row)
+        if len(rows) < n:
+            # every row is in use by this batch: go over max_rows
+            more = n - len(rows)
+            rows += list(range(self.size, self.size + more))
+            self.reserve(self.size + more)
+            self.keys.extend([None] * more)
+            self.size += more
+        return rows
+
+    def reserve(self, size):
+        capacity = len(self.words)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        if self.max_rows is not None and size <= self.max_rows:
+            capacity = min(capacity, self.max_rows)
+        words = torch.empty(
+            (capacity, self.words.shape[1]), dtype=torch.int64, device=self.device
+        )
+        words[: self.size] = self.words[: self.size]
+        self.words = words
+        last_used = np.zeros(capacity, dtype=np.int64)
+        last_used[: self.size] = self.last_used[: self.size]
+        self.last_used = last_used
+
+    # Gather the masks for a list of row indices.
+    def gather(self, rows):
+        rows = torch.tensor(rows, dtype=torch.int64).to(self.device, non_blocking=True)
+        return self.words.index_select(0, rows)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self.size,
+            "bytes": self.nbytes,
+        }
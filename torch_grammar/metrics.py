@@ -0,0 +1,100 @@
+# Metrics hooks.
+#
+# A GrammarSampler created with `metrics=Metrics()` (or any object with the
+# same count/observe methods, e.g. one forwarding to a monitoring system)
+# reports what it spends time on. With the default of None, every
+# instrumented spot is a single `is not None` check.
+#
+# Counters:
+#   masks_computed        per-stack masks computed (not found in any cache)
+#   masks_from_disk       per-stack masks read from the persistent cache
+#   grammars_compiled     grammars compiled by a GrammarRegistry
+#   grammars_reused       registry lookups that found a compiled grammar
+#   grammars_evicted      grammars dropped by a registry to stay in its limits
+#
+# Histograms (seconds, except the last two):
+#   advance_stack_seconds   advance_stack cache misses, including the nested
+#                           advance_stack calls they make
+#   traverse_seconds        token trie traversals
+#   dfa_mask_seconds        masks from a DFA token table (see regular.py)
+#   loop_mask_seconds       masks from a character class loop table
+#   upload_seconds          creating mask tensors and copying them to the
+#                           device
+#   compile_seconds         compiling a grammar in a GrammarRegistry
+#   filter_logits_seconds   masking a batch of scores, mask computation and
+#                           upload included
+#   stacks                  live stacks per row, at each step
+#   stack_depth             the deepest stack per row, at each step
+#
+# Cache hit, miss and eviction counts come from GrammarSampler.cache_stats().
+
+import math
+
+
+# Histograms keep counts in power-of-two buckets, so they use constant memory
+# however long they run. Quantiles are resolved to a bucket's upper bound
+# (within a factor of two).
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        # frexp(v) = (m, e) with v = m * 2**e and 0.5 <= m < 1, so v <= 2**e.
+        exponent = math.frexp(value)[1] if value > 0 else -math.inf
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return min(2.0**exponent, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+# An in-memory registry of counters and histograms.
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def summary(self):
+        return {
+            "counters": dict(self.counters),
+            "histograms": {
+                name: histogram.summary()
+                for name, histogram in sorted(self.histograms.items())
+            },
+        }
@@ -0,0 +1,113 @@
+from .grammar_sampler import GrammarSampler, HOST_CACHE_BYTES, DEVICE_CACHE_BYTES
+from .grammar_cache import cache_key
+from .token_trie import TokenTrie
+from collections import OrderedDict
+import time
+
+
+# Compiled grammars for one tokenizer, e.g. per-request tool schemas or JSON
+# formats on a serving node. The vocab is read and the token trie built once,
+# and every grammar is compiled against that shared trie (and its padded byte
+# matrix), so adding a grammar costs only parsing and optimizing it. With
+# `cache_dir`, grammars are loaded from the cache against the same trie, and
+# the trie is persisted once for all of them.
+#
+# Grammars are deduplicated by their grammar cache key, and the
+# least recently used ones are dropped, with their caches, beyond
+# `max_grammars` or when their host caches together exceed `max_host_bytes`.
+# Other keyword arguments (cache_dir, optimize, metrics, host_cache_bytes,
+# device_cache_bytes) are passed to each GrammarSampler.
+class GrammarRegistry:
+    def __init__(
+        self,
+        tokenizer,
+        max_grammars=64,
+        max_host_bytes=None,
+        cache_dir=None,
+        optimize=True,
+        metrics=None,
+        host_cache_bytes=HOST_CACHE_BYTES,
+        device_cache_bytes=DEVICE_CACHE_BYTES,
+    ):
+        if isinstance(tokenizer, TokenTrie):
+            self.token_trie = tokenizer
+        else:
+            self.token_trie = TokenTrie(tokenizer)
+        self.token_trie.padded_bytes()
+        self.max_grammars = max_grammars
+        self.max_host_bytes = max_host_bytes
+        self.cache_dir = cache_dir
+        self.optimize = optimize
+        self.metrics = metrics
+        self.host_cache_bytes = host_cache_bytes
+        self.device_cache_bytes = device_cache_bytes
+        self.grammars = OrderedDict()
+
+    def key(self, input_text, start_rule_name):
+        return cache_key(input_text, start_rule_name, self.token_trie, self.optimize)
+
+    # The sampler for a grammar, compiled on first use.
+    def get(self, input_text, start_rule_name="root"):
+        key = self.key(input_text, start_rule_name)
+        grammar = self.grammars.get(key)
+        if grammar is not None:
+            self.grammars.move_to_end(key)
+            if self.metrics is not None:
+                self.metrics.count("grammars_reused")
+            return grammar
+
+        st = time.perf_counter()
+        grammar = GrammarSampler(
+            input_text,
+            start_rule_name,
+            self.token_trie,
+            cache_dir=self.cache_dir,
+            optimize=self.optimize,
+            metrics=self.metrics,
+            host_cache_bytes=self.host_cache_bytes,
+            device_cache_bytes=self.device_cache_bytes,
+        )
+        self.grammars[key] = grammar
+        if self.metrics is not None:
+            self.metrics.count("grammars_compiled")
+            self.metrics.observe("compile_seconds", time.perf_counter() - st)
+        self.evict()
+        return grammar
+
+    # Drop least recently used grammars until the registry is within its
+    # limits. The most recently used grammar is always kept.
+    def evict(self):
+        while len(self.grammars) > 1 and (
+            len(self.grammars) > self.max_grammars
+            or (
+                self.max_host_bytes is not None
+                and self.memory_usage()["host"] > self.max_host_bytes
+            )
+        ):
+            self.grammars.popitem(last=False)
+            if self.metrics is not None:
+                self.metrics.count("grammars_evicted")
+
+    def remove(self, input_text, start_rule_name="root"):
+        self.grammars.pop(self.key(input_text, start_rule_name), None)
+
+    def __contains__(self, grammar):
+        input_text, start_rule_name = grammar
+        return self.key(input_text, start_rule_name) in self.grammars
+
+    def __len__(self):
+        return len(self.grammars)
+
+    # Bytes held by the caches and states of all registered grammars (see
+    # GrammarSampler.memory_usage).
+    def memory_usage(self):
+        host = 0
+        states = 0
+        devices = {}
+        for grammar in self.grammars.values():
+            usage = grammar.memory_usage()
+            host += usage["host"]
+            states += usage["states"]
+            for device, nbytes in usage["devices"].items():
+                devices[device] = devices.get(device, 0) + nbytes
+        return {"host": host, "states": states, "devices": devices}
@@ -0,0 +1,422 @@
+# Regular rules compiled to byte-level DFAs.
+#
+# A rule is regular when every reference inside a cycle of rules reachable
+# from it is in tail position (the last element of its alternative), as in the
+# rules generated for `x*` and `x+`: expanding it never grows the stack
+# without bound. Such a rule is compiled by subset construction over the
+# stacks it can be in (relative to the rule itself) and then minimized.
+#
+# DFA states are placed on graph-structured stacks as virtual grammar
+# positions past the end of the binary grammar, so the rest of the sampler
+# handles them like any other position. The position for state `s` of the DFA
+# for rule `r` is `base + r * MAX_STATES + s`, which depends only on the
+# grammar, so masks persisted by digest stay valid across processes.
+
+import numpy as np
+
+# Rules whose DFA would have more states than this are left to the PDA.
+MAX_STATES = 1024
+# So are rules with more grammar positions than this, counting those of the
+# rules they reference: their DFAs rarely fit in MAX_STATES, and finding out
+# is slow.
+MAX_POSITIONS = 1024
+
+REJECT = -1
+
+
+def references(src, rules, rule_id):
+    pos = rules[rule_id] + 1
+    while src[pos]:
+        end = pos + src[pos]
+        pos += 1
+        while pos < end:
+            if src[pos] == 1:
+                yield src[pos + 1], src[pos + 2] == 0
+                pos += 2
+            else:
+                pos += 1 + src[pos]
+        pos += 1
+
+
+# A rule's number of grammar positions, and the positions of its character
+# classes.
+def rule_positions(src, rules, rule_id):
+    count = 0
+    chars = []
+    pos = rules[rule_id] + 1
+    while src[pos]:
+        end = pos + src[pos]
+        pos += 1
+        while pos < end:
+            count += 1
+            if src[pos] == 1:
+                pos += 2
+            else:
+                chars.append(pos)
+                pos += 1 + src[pos]
+        pos += 1
+    return count, chars
+
+
+# Partition the bytes into classes that every character class in the grammar
+# accepts or rejects as a whole. Returns the class of each byte, with classes
+# numbered in order of their first byte, so that a DFA over classes (see
+# build_dfa) is minimized into the same states as one over bytes.
+def byte_classes(src, rules):
+    labels = np.zeros(256, dtype=np.int64)
+    seen = set()
+    for rule_id, pos in enumerate(rules):
+        if pos is None:
+            continue
+        for char_pos in rule_positions(src, rules, rule_id)[1]:
+            ranges = tuple(src[char_pos + 1 : char_pos + 1 + src[char_pos]])
+            if ranges in seen:
+                continue
+            seen.add(ranges)
+            accepts = np.zeros(256, dtype=np.int64)
+            for lo, hi in zip(ranges[::2], ranges[1::2]):
+                accepts[lo : hi + 1] = 1
+            _, labels = np.unique(labels * 2 + accepts, return_inverse=True)
+    _, first, labels = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[labels.reshape(-1)]
+
+
+# The ids of all regular rules, found with Tarjan's algorithm: a rule is
+# regular when no reference within its strongly connected component is in a
+# non-tail position, and every rule it references is regular.
+def regular_rule_ids(src, rules):
+    index = {}
+    low = {}
+    component = {}
+    stack = []
+    components = []
+
+    def defined(rule_id):
+        return rule_id < len(rules) and rules[rule_id] is not None
+
+    def visit(root):
+        todo = [(root, iter(references(src, rules, root)))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        while todo:
+            rule_id, refs = todo[-1]
+            for ref, _ in refs:
+                if not defined(ref):
+                    continue
+                if ref not in index:
+                    index[ref] = low[ref] = len(index)
+                    stack.append(ref)
+                    todo.append((ref, iter(references(src, rules, ref))))
+                    break
+                if ref not in component:
+                    low[rule_id] = min(low[rule_id], index[ref])
+            else:
+                todo.pop()
+                if todo:
+                    parent = todo[-1][0]
+                    low[parent] = min(low[parent], low[rule_id])
+                if low[rule_id] == index[rule_id]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        component[member] = len(components)
+                        members.append(member)
+                        if member == rule_id:
+                            break
+                    components.append(members)
+
+    for rule_id, pos in enumerate(rules):
+        if pos is not None and rule_id not in index:
+            visit(rule_id)
+
+    # Components are completed callees first, so one pass in order suffices.
+    regular = set()
+    for i, members in enumerate(components):
+        ok = True
+        for rule_id in members:
+            for ref, tail in references(src, rules, rule_id):
+                if not defined(ref):
+                    ok = False
+                elif component[ref] == i:
+                    ok = ok and tail
+                else:
+                    ok = ok and ref in regular
+        if ok:
+            regular.update(members)
+    return regular
+
+
+# Subset construction. A DFA state is a frozenset of linear stacks (tuples of
+# grammar positions, top last) within the rule; the empty tuple means the rule
+# is complete. Transitions are computed per byte class (see byte_classes, by
+# default the grammar's) and only expanded to bytes after minimization.
+# Returns (delta, accepting) with state 0 as the start, or None if there are
+# more than `max_states` states.
+def build_dfa(src, rules, rule_id, max_states=MAX_STATES, classes=None):
+    if classes is None:
+        classes = byte_classes(src, rules)
+    num_classes = int(classes.max()) + 1
+    acceptance = {}
+
+    # The classes that the character class at `pos` accepts.
+    def class_acceptance(pos):
+        if pos not in acceptance:
+            accepts = np.zeros(256, dtype=bool)
+            for i in range(pos + 1, pos + 1 + src[pos], 2):
+                accepts[src[i] : src[i + 1] + 1] = True
+            acceptance[pos] = np.unique(classes[accepts]).tolist()
+        return acceptance[pos]
+
+    def expand_rule(ref, below, out):
+        subpos = rules[ref] + 1
+        while src[subpos]:
+            if src[subpos + 1]:
+                expand(below + (subpos + 1,), out)
+            else:
+                expand(below, out)
+            subpos += 1 + src[subpos]
+
+    # Add the stacks reachable from `stack` without consuming a byte.
+    def expand(stack, out):
+        if stack in out:
+            return
+        out.add(stack)
+        if not stack or src[stack[-1]] > 1:
+            return
+        pos = stack[-1]
+        below = stack[:-1] + ((pos + 2,) if src[pos + 2] else ())
+        expand_rule(src[pos + 1], below, out)
+
+    def closure(stacks):
+        return frozenset(s for s in stacks if not s or src[s[-1]] > 1)
+
+    start = set()
+    expand_rule(rule_id, (), start)
+    configs = [closure(start)]
+    config_ids = {configs[0]: 0}
+    delta = []
+    successors = {}
+
+    i = 0
+    while i < len(configs):
+        config = [stack for stack in configs[i] if stack]
+        i += 1
+        # Every byte a stack accepts moves it to the same successors.
+        for stack in config:
+            if stack not in successors:
+                pos = stack[-1]
+                pos += src[pos] + 1
+                below = stack[:-1] + ((pos,) if src[pos] else ())
+                out = set()
+                expand(below, out)
+                successors[stack] = closure(out)
+        # The stacks that accept each class, and where they lead.
+        accepted = [[] for _ in range(num_classes)]
+        for stack in config:
+            for byte_class in class_acceptance(stack[-1]):
+                accepted[byte_class].append(stack)
+        row = [REJECT] * num_classes
+        targets = {}
+        for byte_class, stacks in enumerate(accepted):
+            if not stacks:
+                continue
+            key = tuple(stacks)
+            target_id = targets.get(key)
+            if target_id is None:
+                target = frozenset().union(*(successors[s] for s in stacks))
+                target_id = config_ids.get(target)
+                if target_id is None:
+                    if len(configs) >= max_states:
+                        return None
+                    target_id = config_ids[target] = len(configs)
+                    configs.append(target)
+                targets[key] = target_id
+            row[byte_class] = target_id
+        delta.append(row)
+
+    accepting = np.array([() in config for config in configs])
+    delta, accepting = minimize(np.array(delta, dtype=np.int32), accepting)
+    return delta[:, classes], accepting
+
+
+# Moore's partition refinement, then renumbering in breadth-first order from
+# the start state so that the result is canonical. `delta` has a column per
+# byte or byte class.
+def minimize(delta, accepting):
+    n, width = delta.shape
+    # Send rejections to an explicit dead state (index n) while refining.
+    full = np.where(delta == REJECT, n, delta)
+    full = np.vstack([full, np.full(width, n, dtype=full.dtype)])
+    labels = np.append(accepting, False).astype(np.int64)
+    labels[n] = -1
+    num_labels = len(set(labels.tolist()))
+    while True:
+        signature = np.column_stack([labels, labels[full]])
+        ids = {}
+        new_labels = np.array(
+            [ids.setdefault(row, len(ids)) for row in map(tuple, signature.tolist())]
+        )
+        if len(ids) == num_labels:
+            break
+        labels = new_labels
+        num_labels = len(ids)
+
+    dead = labels[n]
+    order = {labels[0]: 0}
+    representative = {labels[0]: 0}
+    queue = [0]
+    while queue:
+        state = queue.pop(0)
+        for target in full[state]:
+            label = labels[target]
+            if label != dead and label not in order:
+                order[label] = len(order)
+                representative[label] = target
+                queue.append(target)
+    states = sorted(order, key=order.get)
+    new_delta = np.full((len(states), width), REJECT, dtype=np.int32)
+    new_accepting = np.zeros(len(states), dtype=bool)
+    for label in states:
+        state = representative[label]
+        targets = labels[full[state]]
+        live = targets != dead
+        new_delta[order[label], live] = [order[t] for t in targets[live]]
+        new_accepting[order[label]] = accepting[state]
+    return new_delta, new_accepting
+
+
+# DFAs for the regular rules of a grammar, compiled on first use. The start
+# rule, and any rule that refers back to it, is always left to the PDA: it
+# spans the whole grammar, so its DFA would only be worth it for the smallest
+# grammars.
+class RegularRules:
+    def __init__(
+        self,
+        src,
+        rules,
+        start_rule_id=None,
+        max_states=MAX_STATES,
+        max_positions=MAX_POSITIONS,
+    ):
+        self.src = src
+        self.rules = rules
+        self.max_states = max_states
+        self.max_positions = max_positions
+        self.base = len(src)
+        self.regular = regular_rule_ids(src, rules)
+        if start_rule_id is not None:
+            self.regular -= self.referrers(start_rule_id)
+        self.classes = None
+        self.dfas = {}
+
+    # The rules from which `rule_id` can be reached, including itself.
+    def referrers(self, rule_id):
+        users = {}
+        for user, pos in enumerate(self.rules):
+            if pos is not None:
+                for ref, _ in references(self.src, self.rules, user):
+                    users.setdefault(ref, set()).add(user)
+        found = {rule_id}
+        todo = [rule_id]
+        while todo:
+            for user in users.get(todo.pop(), ()):
+                if user not in found:
+                    found.add(user)
+                    todo.append(user)
+        return found
+
+    # Whether the positions of `rule_id` and the rules it references add up
+    # to at most max_positions.
+    def is_small(self, rule_id):
+        count = 0
+        seen = {rule_id}
+        todo = [rule_id]
+        while todo:
+            ref = todo.pop()
+            count += rule_positions(self.src, self.rules, ref)[0]
+            if count > self.max_positions:
+                return False
+            for ref, _ in references(self.src, self.rules, ref):
+                if ref not in seen:
+                    seen.add(ref)
+                    todo.append(ref)
+        return True
+
+    # The virtual position of the start of `rule_id`'s DFA, or None if the
+    # rule isn't compiled.
+    def start(self, rule_id):
+        if rule_id not in self.regular:
+            return None
+        if rule_id not in self.dfas:
+            dfa = None
+            if self.is_small(rule_id):
+                if self.classes is None:
+                    self.classes = byte_classes(self.src, self.rules)
+                dfa = build_dfa(
+                    self.src, self.rules, rule_id, self.max_states, self.classes
+                )
+            if dfa is not None:
+                delta, accepting = dfa
+                dfa = (delta.tolist(), accepting.tolist(), delta, accepting)
+            self.dfas[rule_id] = dfa
+        if self.dfas[rule_id] is None:
+            return None
+        return self.base + rule_id * self.max_states
+
+    def is_virtual(self, pos):
+        return pos >= self.base
+
+    def dfa(self, pos):
+        rule_id, state = divmod(pos - self.base, self.max_states)
+        return self.dfas[rule_id], state
+
+    # The virtual position after `byte`, or None if it is rejected.
+    def step(self, pos, byte):
+        (delta, _, _, _), state = self.dfa(pos)
+        target = delta[state][byte]
+        if target == REJECT:
+            return None
+        return pos - state + target
+
+    def is_accepting(self, pos):
+        (_, accepting, _, _), state = self.dfa(pos)
+        return accepting[state]
+
+    def char_acceptance(self, pos):
+        (delta, _, _, _), state = self.dfa(pos)
+        return [target != REJECT for target in delta[state]]
+
+    # Run every token through the DFA from `pos` (see run_dfa).
+    def run_tokens(self, pos, lengths, matrix):
+        (_, _, delta, accepting), state = self.dfa(pos)
+        return run_dfa(delta, accepting, state, lengths, matrix)
+
+
+# Run every token through a DFA from `state`, with tokens given as a
+# TokenTrie.padded_bytes() matrix. Returns a bool array over the matrix rows of
+# the tokens whose bytes all stay within the DFA, and the (row, offset) pairs
+# at which a token reaches an accepting state with bytes left over, i.e. where
+# it can leave the DFA part way through.
+def run_dfa(delta, accepting, state, lengths, matrix):
+    states = np.full(len(lengths), state, dtype=np.int32)
+    exit_rows = []
+    exit_offsets = []
+    # Rows are sorted by decreasing length, so the tokens still being read at
+    # each offset are a prefix of them.
+    active = np.searchsorted(-lengths, -np.arange(matrix.shape[1] + 1), "right")
+    for offset in range(matrix.shape[1]):
+        n = active[offset + 1]
+        if offset > 0:
+            live = states[:n] != REJECT
+            leaving = np.flatnonzero(live & accepting[states[:n]])
+            exit_rows.append(leaving)
+            exit_offsets.append(np.full(len(leaving), offset))
+        current = states[:n]
+        live = current != REJECT
+        current[live] = delta[current[live], matrix[:n, offset][live]]
+    full = states != REJECT
+    if exit_rows:
+        return full, np.concatenate(exit_rows), np.concatenate(exit_offsets)
+    return full, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
@@ -1,70 +1,331 @@
+import hashlib
 import re
+import numpy as np
 
-LEAF = -1
+NO_TOKEN = -1
 
+# Bump whenever the layout written by TokenTrie.save changes.
+VOCAB_FORMAT_VERSION = 1
 
+BYTE_TOKEN = re.compile(r"<0x([0-9a-fA-F]{2})>")
+
+
+# The printable characters that byte-level BPE vocabularies (GPT-2 and its
+# descendants) use to stand for each byte.
+def bytes_to_unicode():
+    printable = [
+        *range(ord("!"), ord("~") + 1),
+        *range(ord("¡"), ord("¬") + 1),
+        *range(ord("®"), ord("ÿ") + 1),
+    ]
+    chars = {}
+    n = 0
+    for byte in range(256):
+        if byte in printable:
+            chars[byte] = chr(byte)
+        else:
+            chars[byte] = chr(256 + n)
+            n += 1
+    return chars
+
+
+BYTE_DECODER = {c: byte for byte, c in bytes_to_unicode().items()}
+
+
+# The trie is stored flat, in depth-first preorder, as four parallel arrays:
+#
+# - node_bytes[i]:   the byte on the edge leading into node i (root: 0)
+# - node_depths[i]:  the number of bytes from the root to node i
+# - subtree_ends[i]: one past the last node in i's subtree; the first child of
+#                    i is i + 1 (if that is < subtree_ends[i]) and the next
+#                    sibling of i is subtree_ends[i]
+# - node_tokens[i]:  the token id spelled by the path to node i, or NO_TOKEN
+#
+# Compared to a dict per node this is a few bytes per node, and traversal is a
+# single loop that can skip a rejected subtree in one step.
 class TokenTrie:
+    ARRAYS = ("node_bytes", "node_depths", "node_tokens", "subtree_ends")
+
     def __init__(self, tokenizer):
         self.eos_token_id = tokenizer.eos_token_id
         self.tokens = []
-        self.trie = {}
         self.load_tokens(tokenizer)
 
+    # Rebuild a trie from previously built arrays (which may be memory-mapped)
+    # without touching the tokenizer.
+    @classmethod
+    def from_arrays(cls, eos_token_id, tokens, arrays):
+        trie = cls.__new__(cls)
+        trie.eos_token_id = eos_token_id
+        trie.tokens = tokens
+        for name in cls.ARRAYS:
+            setattr(trie, name, arrays[name])
+        trie.max_depth = int(trie.node_depths.max())
+        return trie
+
+    # Whether a token has its own node in the trie. When several tokens have
+    # the same bytes only one of them does, and only that one is ever marked
+    # as accepted in a mask.
+    def __contains__(self, token_id):
+        if not hasattr(self, "_leaf_tokens"):
+            self._leaf_tokens = set(
+                self.node_tokens[self.node_tokens != NO_TOKEN].tolist()
+            )
+        return token_id in self._leaf_tokens
+
+    # The bytes of the tokens that have a node in the trie, as a zero-padded
+    # matrix with one row per token, longest first. Returns (token_ids,
+    # lengths, matrix); built on first use.
+    def padded_bytes(self):
+        if not hasattr(self, "_padded_bytes"):
+            token_ids = np.sort(self.node_tokens[self.node_tokens != NO_TOKEN])
+            entries = [self.tokens[i] for i in token_ids.tolist()]
+            lengths = np.fromiter(map(len, entries), dtype=np.int64, count=len(entries))
+            order = np.argsort(-lengths, kind="stable")
+            token_ids = token_ids[order]
+            lengths = lengths[order]
+            flat = np.frombuffer(
+                b"".join(entries[i] for i in order.tolist()), dtype=np.uint8
+            )
+            starts = np.cumsum(lengths) - lengths
+            rows = np.repeat(np.arange(len(lengths)), lengths)
+            cols = np.arange(len(flat)) - np.repeat(starts, lengths)
+            matrix = np.zeros((len(lengths), lengths.max(initial=0)), dtype=np.uint8)
+            matrix[rows, cols] = flat
+            self._padded_bytes = (token_ids, lengths, matrix)
+        return self._padded_bytes
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
     def id2str(self, token_id):
         return self.tokens[token_id]
 
     def __len__(self):
         return len(self.tokens)
 
+    # Read the bytes of every token from the tokenizer's vocab in one pass,
+    # without calling into the tokenizer per token.
     def load_tokens(self, tokenizer):
-        def replace_hex(match):
-            hex_value = match.group(1)
-            return chr(int(hex_value, 16))
-
-        if "gpt2" in tokenizer.__class__.__name__.lower():
-            special = tokenizer.additional_special_tokens_ids
-
-            # Here, the decoder does a string replace on a bunch of sequences
-            # like ' .' for '.'. This interferes with our assumptions, where a
-            # token should always have exactly one representation.
-            # Fortunately(?) text-generation-inference doesn't seem to run this
-            # cleanup, so we get extraneous spaces. So, in order to generate
-            # the right token set for TGI, we have to skip the space trimming.
-            # See:
+        name = tokenizer.__class__.__name__.lower()
+        if "gpt2" in name:
+            special = set(tokenizer.additional_special_tokens_ids)
+
+            # Byte-level BPE vocab entries spell each byte as one character
+            # (see bytes_to_unicode). Mapping them back directly gives the
+            # exact bytes of the token, where decode() would replace bytes
+            # that aren't valid UTF-8 on their own. It also skips the
+            # decoder's cleanup of sequences like ' .', which
+            # text-generation-inference doesn't run either. See:
             # https://github.com/huggingface/transformers/blob/main/src/transformers/tokenization_utils_base.py#L3588-L3600
-            def fmt_token(id):
-                if id in special:
+            def fmt_token(token, token_id):
+                if token_id in special:
                     return None
-                return bytes(
-                    tokenizer.decode([id], clean_up_tokenization_spaces=False), "utf-8"
-                )
+                try:
+                    return bytes(BYTE_DECODER[c] for c in token)
+                except KeyError:  # added tokens aren't byte-level encoded
+                    return token.encode("utf-8")
 
-        elif "llama" in tokenizer.__class__.__name__.lower():
+        elif "llama" in name:
 
-            def fmt_token(id):
-                token = tokenizer.convert_ids_to_tokens(id)
-                token = re.sub(r"<0x([0-9a-fA-F]{2})>", replace_hex, token)
-                token = token.replace("▁", " ")
-                return bytes(token, "utf-8")
+            def fmt_token(token, token_id):
+                match = BYTE_TOKEN.fullmatch(token)
+                if match:
+                    return bytes([int(match.group(1), 16)])
+                return token.replace("▁", " ").encode("utf-8")
 
         else:
             print("Warning: unrecognized tokenizer: using default token formatting")
 
-            def fmt_token(id):
-                token = tokenizer.convert_ids_to_tokens(id)
-                return bytes(token, "utf-8")
+            def fmt_token(token, token_id):
+                return token.encode("utf-8")
 
         # note: vocab_size doesn't work here because there are also
         # get_added_vocab() tokens
-        self.tokens = [fmt_token(i) for i in range(len(tokenizer.get_vocab()))]
-        for token_id, token_bytes in enumerate(self.tokens):
-            if token_bytes is not None:
-                self.insert_into_trie(self.trie, token_bytes, token_id)
-
-    def insert_into_trie(self, trie, token_bytes, token_id):
-        current = trie
-        for byte in token_bytes:
-            if byte not in current:
-                current[byte] = {}
-            current = current[byte]
-        current[LEAF] = token_id
+        vocab = tokenizer.get_vocab()
+        self.tokens = [None] * (max(vocab.values(), default=-1) + 1)
+        for token, token_id in vocab.items():
+            self.tokens[token_id] = fmt_token(token, token_id)
+        self.build(self.tokens)
+
+    # Write the token bytes and trie arrays to one file, which load() reads
+    # back without the tokenizer (e.g. in worker processes).
+    def save(self, path):
+        token_lengths, token_data = encode_tokens(self.tokens)
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                version=np.int32(VOCAB_FORMAT_VERSION),
+                eos_token_id=np.int64(self.eos_token_id),
+                token_lengths=token_lengths,
+                token_data=token_data,
+                **self.arrays(),
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            if int(arrays["version"]) != VOCAB_FORMAT_VERSION:
+                raise RuntimeError(f"vocab file version mismatch at {path}")
+            tokens = decode_tokens(arrays["token_lengths"], arrays["token_data"])
+            return cls.from_arrays(
+                int(arrays["eos_token_id"]),
+                tokens,
+                {name: arrays[name] for name in cls.ARRAYS},
+            )
+
+    # A digest of the token bytes and EOS id, which determine every mask.
+    def fingerprint(self):
+        if not hasattr(self, "_fingerprint"):
+            token_lengths, token_data = encode_tokens(self.tokens)
+            h = hashlib.sha256()
+            h.update(str(self.eos_token_id).encode() + b"\0")
+            h.update(token_lengths.astype("<i4").tobytes())
+            h.update(token_data.tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    # Build the flat trie from a list of token byte strings (None for tokens
+    # that should never be produced), with NumPy doing the per-byte work.
+    def build(self, tokens):
+        # Sorting the byte strings puts every token right after its longest
+        # prefix in the vocab, so nodes can be laid out in preorder. The sort is
+        # stable, so when several ids share the same bytes the highest id wins.
+        order = [i for i, token_bytes in enumerate(tokens) if token_bytes is not None]
+        order.sort(key=tokens.__getitem__)
+        entries = [tokens[i] for i in order]
+        n = len(entries)
+        token_ids = np.array(order, dtype=np.int32)
+        lengths = np.fromiter(map(len, entries), dtype=np.int64, count=n)
+        flat = np.frombuffer(b"".join(entries), dtype=np.uint8)
+        offsets = np.zeros(n, dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+
+        # Longest common prefix of each token with the one sorted before it:
+        # compare every byte pair up to the shorter length and keep the first
+        # mismatch of each pair.
+        lcp = np.zeros(n, dtype=np.int64)
+        shared = np.minimum(lengths[1:], lengths[:-1])
+        lcp[1:] = shared
+        pair = np.repeat(np.arange(1, n), shared)
+        col = np.arange(len(pair)) - np.repeat(np.cumsum(shared) - shared, shared)
+        differ = flat[offsets[pair] + col] != flat[offsets[pair - 1] + col]
+        pair = pair[differ]
+        col = col[differ]
+        first_differ = np.ones(len(pair), dtype=bool)
+        first_differ[1:] = pair[1:] != pair[:-1]
+        lcp[pair[first_differ]] = col[first_differ]
+
+        # Each token adds a node for every byte past its common prefix. Node 0
+        # is the root; `first[k]` is the first node added by token k.
+        counts = lengths - lcp
+        first = np.ones(n, dtype=np.int64)
+        np.cumsum(counts[:-1], out=first[1:])
+        first[1:] += 1
+        num_nodes = int(counts.sum()) + 1
+        owner = np.repeat(np.arange(n), counts)
+        depths = np.arange(1, num_nodes) - np.repeat(first - lcp - 1, counts)
+
+        node_depths = np.zeros(num_nodes, dtype=np.int32)
+        node_depths[1:] = depths
+        node_bytes = np.zeros(num_nodes, dtype=np.uint8)
+        node_bytes[1:] = flat[offsets[owner] + depths - 1]
+
+        # A token that adds no nodes has the same bytes as the one before it and
+        # ends on the same node.
+        terminal = np.where(counts > 0, first + counts - 1, 0)
+        np.maximum.accumulate(terminal, out=terminal)
+        last = np.ones(n, dtype=bool)
+        last[:-1] = terminal[1:] != terminal[:-1]
+        node_tokens = np.full(num_nodes, NO_TOKEN, dtype=np.int32)
+        node_tokens[terminal[last]] = token_ids[last]
+
+        # The subtree of a node at depth d added by token k ends where the first
+        # later token that shares fewer than d bytes with its predecessor
+        # starts.
+        subtree_ends = np.full(num_nodes, num_nodes, dtype=np.int32)
+        starts = np.append(first, num_nodes)
+        by_depth = np.argsort(depths, kind="stable")
+        bounds = np.searchsorted(depths[by_depth], np.arange(depths.max(initial=0) + 2))
+        for depth in range(1, len(bounds) - 1):
+            nodes = by_depth[bounds[depth] : bounds[depth + 1]]
+            if not len(nodes):
+                continue
+            closers = np.append(np.flatnonzero(lcp < depth), n)
+            closer = closers[np.searchsorted(closers[:-1], owner[nodes], side="right")]
+            subtree_ends[nodes + 1] = starts[closer]
+
+        self.node_bytes = node_bytes
+        self.node_depths = node_depths
+        self.node_tokens = node_tokens
+        self.subtree_ends = subtree_ends
+        self.max_depth = int(node_depths.max())
+
+    # Depth-first walk over every token reachable from `state`.
+    # `step(byte, state)` returns the state after consuming `byte`, or a falsy
+    # value to prune the subtree below that byte. Returns the ids of tokens
+    # whose bytes were all consumed.
+    def traverse(self, state, step):
+        node_bytes = memoryview(self.node_bytes)
+        node_depths = memoryview(self.node_depths)
+        node_tokens = memoryview(self.node_tokens)
+        subtree_ends = memoryview(self.subtree_ends)
+
+        accepted = []
+        if node_tokens[0] != NO_TOKEN:
+            accepted.append(node_tokens[0])
+
+        states = [None] * (self.max_depth + 1)
+        states[0] = state
+        node = 1
+        num_nodes = len(node_bytes)
+        while node < num_nodes:
+            depth = node_depths[node]
+            next_state = step(node_bytes[node], states[depth - 1])
+            if not next_state:
+                node = subtree_ends[node]
+                continue
+            states[depth] = next_state
+            token_id = node_tokens[node]
+            if token_id != NO_TOKEN:
+                accepted.append(token_id)
+            node += 1
+        return accepted
+
+    # The tokens that `data` starts with, shortest first, as (token id, length)
+    # pairs.
+    def prefixes(self, data):
+        node = 0
+        for length, byte in enumerate(data, 1):
+            child = node + 1
+            end = self.subtree_ends[node]
+            while child < end and self.node_bytes[child] != byte:
+                child = self.subtree_ends[child]
+            if child >= end:
+                return
+            node = child
+            if self.node_tokens[node] != NO_TOKEN:
+                yield int(self.node_tokens[node]), length
+
+
+# Flatten a token list into (lengths, data) arrays; tokens that are None get a
+# length of -1.
+def encode_tokens(tokens):
+    lengths = np.array(
+        [-1 if token is None else len(token) for token in tokens], dtype=np.int32
+    )
+    data = np.frombuffer(b"".join(token or b"" for token in tokens), dtype=np.uint8)
+    return lengths, data
+
+
+def decode_tokens(lengths, data):
+    data = bytes(data)
+    tokens = []
+    pos = 0
+    for length in lengths.tolist():
+        if length < 0:
+            tokens.append(None)
+            continue
+        tokens.append(data[pos : pos + length])
+        pos += length
+    return tokens